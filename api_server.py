@@ -1,17 +1,24 @@
 # api_server.py
 
 import os
+import sys
 import json
 import uuid
-import threading
+import functools
 import logging
 import asyncio
-from typing import Optional, Dict, Any
-from fastapi import FastAPI, BackgroundTasks, WebSocket, WebSocketDisconnect
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import Optional, Dict, Any, List, Set
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, ORJSONResponse
 from pydantic import BaseModel
 from dotenv import load_dotenv
 import uvicorn
 
+from core.json_utils import HAS_ORJSON, dumps, loads
+
 # 環境変数のロード
 load_dotenv()
 
@@ -21,199 +28,307 @@ logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
 )
 logger = logging.getLogger("manus-api")
+# ライブラリのフレーム単位のログは抑制
+logging.getLogger("websockets").setLevel(logging.WARNING)
 
-app = FastAPI(title="Manus-Like Agent API")
+# エージェントのブロッキング処理（LLM 呼び出し・同期ツール）を実行する上限付きスレッドプール
+AGENT_MAX_WORKERS = int(os.getenv("AGENT_MAX_WORKERS", "8"))
+AGENT_EXECUTOR = ThreadPoolExecutor(max_workers=AGENT_MAX_WORKERS, thread_name_prefix="agent")
 
-# セッションごとのキュー＆ループ、エージェント保持
-active_sessions: Dict[str, asyncio.Queue] = {}
-user_response_queues: Dict[str, asyncio.Queue] = {}
-session_loops: Dict[str, asyncio.AbstractEventLoop] = {}
-active_agents: Dict[str, Any] = {}
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # run_in_executor(None, ...) がすべて AGENT_EXECUTOR を使うようにする
+    asyncio.get_running_loop().set_default_executor(AGENT_EXECUTOR)
+    yield
+    AGENT_EXECUTOR.shutdown(wait=False, cancel_futures=True)
 
-class TaskRequest(BaseModel):
-    task: str
-    session_id: Optional[str] = None
+app = FastAPI(
+    title="Manus-Like Agent API",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse if HAS_ORJSON else JSONResponse,
+)
 
-class UserResponse(BaseModel):
-    response: str
+# セッションキューの上限。溢れた場合はエージェント側の put が待たされる（back-pressure）
+SESSION_QUEUE_MAXSIZE = 1024
 
-def create_agent(session_id: str):
-    # 各種コンポーネントのインポートと初期化
+def _new_session_queue() -> asyncio.Queue:
+    return asyncio.Queue(maxsize=SESSION_QUEUE_MAXSIZE)
+
+@dataclass
+class Session:
+    """1セッション分の状態（送信/応答キュー、エージェント、実行タスク）"""
+    id: str
+    out_q: asyncio.Queue = field(default_factory=_new_session_queue)
+    in_q: asyncio.Queue = field(default_factory=_new_session_queue)
+    agent: Optional[Any] = None
+    task: Optional[asyncio.Task] = None
+
+# セッションID → Session
+SESSIONS: Dict[str, Session] = {}
+
+def get_session(session_id: str) -> Session:
+    # セッションを取得（未作成なら作成）
+    sess = SESSIONS.get(session_id)
+    if sess is None:
+        sess = SESSIONS[session_id] = Session(session_id)
+    return sess
+
+# 1回の送信（REST 応答 / WebSocket フレーム）にまとめるメッセージの最大数
+MAX_BATCH_SIZE = 32
+WS_MAX_BATCH_SIZE = 64
+# WebSocket 送信前に後続メッセージを待つデバウンス時間（秒）
+WS_BATCH_WINDOW = 0.002
+
+# API 経由のエージェント向けに追加する対話ルール
+INTERACTION_RULES = """
+<interaction_rules>
+- ユーザーから情報を得たいときは必ず message_ask_user を使用すること
+- message_notify_user は一方向通知のみで使用すること
+- message_ask_user 後はユーザー応答を待ち、繰り返しは避けること
+</interaction_rules>
+"""
+
+@functools.lru_cache(maxsize=1)
+def load_system_prompt() -> str:
+    # システムプロンプトはプロセス内で一度だけ読み込み、全セッションで共有する
     from config import CONFIG
-    from core.agent import Agent
-    from tools.tool_registry import ToolRegistry
-    from llm.azure_openai_client import AzureOpenAIClient
-    from core.planner import Planner
-    from core.memory import Memory
-    from core.enhanced_memory import EnhancedMemory
 
-    # システムプロンプト読み込み
     prompt_path = os.path.join(CONFIG["system"]["prompt_dir"], "system_prompt.txt")
     if os.path.exists(prompt_path):
         with open(prompt_path, encoding="utf-8") as f:
             system_prompt = f.read()
     else:
         system_prompt = "あなたはManusのようなエージェントです。"
-    system_prompt += """
-<interaction_rules>
-- ユーザーから情報を得たいときは必ず message_ask_user を使用すること
-- message_notify_user は一方向通知のみで使用すること
-- message_ask_user 後はユーザー応答を待ち、繰り返しは避けること
-</interaction_rules>
-"""
+    return system_prompt + INTERACTION_RULES
+
+@functools.lru_cache(maxsize=1)
+def get_llm_client():
+    # LLM クライアントは HTTP コネクションプールごと全セッションで共有する
+    from llm.azure_openai_client import AzureOpenAIClient
+    return AzureOpenAIClient()
+
+@functools.lru_cache(maxsize=1)
+def get_planner():
+    # Planner は状態を持たないため共有クライアントと合わせて使い回す
+    from core.planner import Planner
+    return Planner(get_llm_client())
+
+# 全セッション共通で登録するツールモジュール
+TOOL_MODULES = (
+    "tools.message_tools",
+    "tools.shell_tools",
+    "tools.file_tools",
+    "tools.info_tools",
+    "tools.deploy_tools",
+    "tools.browser_tools",
+    "tools.codeact_tools",
+    "tools.system_tools",
+)
 
-    # LLMクライアント＆ツールレジストリ初期化
-    llm_client = AzureOpenAIClient()
-    planner = Planner(llm_client)
+@functools.lru_cache(maxsize=1)
+def get_base_registry():
+    # モジュールの走査はプロセス内で一度だけ行い、セッションごとには fork() する
+    from tools.tool_registry import ToolRegistry
     registry = ToolRegistry()
-    for mod in [
-        "tools.shell_tools",
-        "tools.file_tools",
-        "tools.info_tools",
-        "tools.deploy_tools",
-        "tools.browser_tools",
-        "tools.codeact_tools",
-        "tools.system_tools",
-    ]:
+    for mod in TOOL_MODULES:
         registry.register_tools_from_module(mod)
+    return registry
+
+class TaskRequest(BaseModel):
+    task: str
+    session_id: Optional[str] = None
+
+class UserResponse(BaseModel):
+    response: str
+
+# 作成済みのセッション用ワークスペース（同じセッションIDでの再作成時に makedirs を省く）
+_CREATED_DIRS: Set[str] = set()
+
+def create_agent(sess: Session):
+    # 各種コンポーネントのインポートと初期化
+    from config import WORKSPACE_DIR, USE_VECTOR_MEMORY
+    from core.agent import Agent
+    from core.memory import Memory
+    from core.enhanced_memory import EnhancedMemory
+
+    # システムプロンプト（キャッシュ済み）
+    system_prompt = load_system_prompt()
+
+    # LLMクライアント（共有）＆ツールレジストリ（共通部分を複製）
+    llm_client = get_llm_client()
+    planner = get_planner()
+    registry = get_base_registry().fork()
+
+    # ハンドラはセッションのキューを直接参照する
+    session_id = sess.id
+    notify_q = sess.out_q
+    response_q = sess.in_q
 
-    # message_notify_user ハンドラ
-    def message_notify_handler(message: str, attachments=None):
-        logger.info(f"[{session_id}] Notify: {message[:100]}...")
-        loop = session_loops.get(session_id)
-        queue = active_sessions.get(session_id)
-        if loop and queue:
-            loop.call_soon_threadsafe(queue.put_nowait, {
-                "type": "notify",
-                "content": message,
-                "attachments": attachments
-            })
+    # message_notify_user ハンドラ（エージェントと同じループ上で直接キューに積む）
+    async def message_notify_handler(message: str, attachments=None):
+        logger.info("[%s] Notify: %.100s...", session_id, message)
+        await notify_q.put({
+            "type": "notify",
+            "content": message,
+            "attachments": attachments
+        })
         return "メッセージを送信しました"
 
     # message_ask_user ハンドラ
-    def message_ask_handler(message: str, attachments=None, suggest_user_takeover="none"):
-        logger.info(f"[{session_id}] Ask: {message[:100]}...")
-        loop = session_loops.get(session_id)
-        notify_q = active_sessions.get(session_id)
-        response_q = user_response_queues.get(session_id)
-        if loop and notify_q:
-            loop.call_soon_threadsafe(notify_q.put_nowait, {
-                "type": "ask",
-                "content": message,
-                "attachments": attachments,
-                "suggest_user_takeover": suggest_user_takeover
-            })
-        if response_q and loop:
-            fut = asyncio.run_coroutine_threadsafe(response_q.get(), loop)
+    async def message_ask_handler(message: str, attachments=None, suggest_user_takeover="none"):
+        logger.info("[%s] Ask: %.100s...", session_id, message)
+        # 前の質問がタイムアウトした後に届いた応答を、この質問への回答と取り違えないよう捨てておく
+        while True:
             try:
-                return fut.result(timeout=300)
-            except asyncio.TimeoutError:
-                return "タイムアウトしました"
-        return "セッションが無効です"
-
-    registry.register_tool(
-        "message_notify_user",
-        message_notify_handler,
-        registry.get_tool_spec("message_notify_user")
-    )
-    registry.register_tool(
-        "message_ask_user",
-        message_ask_handler,
-        registry.get_tool_spec("message_ask_user")
-    )
+                response_q.get_nowait()
+            except asyncio.QueueEmpty:
+                break
+        await notify_q.put({
+            "type": "ask",
+            "content": message,
+            "attachments": attachments,
+            "suggest_user_takeover": suggest_user_takeover
+        })
+        try:
+            return await asyncio.wait_for(response_q.get(), timeout=300)
+        except asyncio.TimeoutError:
+            return "タイムアウトしました"
+
+    # 仕様は共通レジストリのものを使い、実装だけセッション用に差し替える
+    registry.set_handler("message_notify_user", message_notify_handler)
+    registry.set_handler("message_ask_user", message_ask_handler)
 
     # メモリ初期化
-    workspace_dir = os.path.join(CONFIG["system"]["workspace_dir"], session_id)
-    os.makedirs(workspace_dir, exist_ok=True)
-    if CONFIG["memory"].get("use_vector_memory", False):
+    workspace_dir = os.path.join(WORKSPACE_DIR, session_id)
+    if workspace_dir not in _CREATED_DIRS:
+        os.makedirs(workspace_dir, exist_ok=True)
+        _CREATED_DIRS.add(workspace_dir)
+    if USE_VECTOR_MEMORY:
         memory = EnhancedMemory(workspace_dir=workspace_dir)
     else:
         memory = Memory(workspace_dir=workspace_dir)
 
-    agent = Agent(llm_client, system_prompt, registry, planner, memory)
-    active_agents[session_id] = agent
-    return agent
+    return Agent(llm_client, system_prompt, registry, planner, memory)
 
-def start_agent_thread(agent, task: str, session_id: str):
+async def start_agent_task(sess: Session, task: str):
+    # エージェント本体をサーバーと同じイベントループ上で実行
     try:
-        agent.start(task)
-        loop = session_loops.get(session_id)
-        queue = active_sessions.get(session_id)
-        if loop and queue:
-            loop.call_soon_threadsafe(queue.put_nowait, {
-                "type": "status",
-                "content": "タスクが完了しました"
-            })
+        await sess.agent.astart(task)
+        await sess.out_q.put({
+            "type": "status",
+            "content": "タスクが完了しました"
+        })
     except Exception as e:
-        loop = session_loops.get(session_id)
-        queue = active_sessions.get(session_id)
-        if loop and queue:
-            loop.call_soon_threadsafe(queue.put_nowait, {
-                "type": "error",
-                "content": f"エラー発生: {e}"
-            })
+        await sess.out_q.put({
+            "type": "error",
+            "content": f"エラー発生: {e}"
+        })
+    finally:
+        sess.task = None
 
 async def run_agent(task: str, session_id: str):
-    # イベントループとキューの設定
-    loop = asyncio.get_running_loop()
-    session_loops.setdefault(session_id, loop)
-    active_sessions.setdefault(session_id, asyncio.Queue())
-    user_response_queues.setdefault(session_id, asyncio.Queue())
-
-    agent = create_agent(session_id)
+    sess = get_session(session_id)
+    # プロンプト読み込み・makedirs・重いインポートを含むためスレッドで構築する
+    agent = await asyncio.to_thread(create_agent, sess)
+    # 構築中に切断されてセッションが破棄・置換されていれば、受け手がいないので起動しない
+    if SESSIONS.get(session_id) is not sess:
+        agent.stop()
+        return
+    sess.agent = agent
 
     # エージェント起動ステータスをフロントへ送信
-    await active_sessions[session_id].put({
+    await sess.out_q.put({
         "type": "status",
         "content": "エージェントが起動しました"
     })
     # 接続確認用テストメッセージを送信
-    await active_sessions[session_id].put({
+    await sess.out_q.put({
         "type": "notify",
         "content": "★ テストメッセージ: 接続確認用 ★"
     })
 
-    # エージェント本体を別スレッドで実行
-    thread = threading.Thread(
-        target=start_agent_thread,
-        args=(agent, task, session_id),
-        daemon=True
-    )
-    thread.start()
+    # エージェント本体を asyncio タスクとして実行（参照を保持して GC を防ぐ）
+    sess.task = asyncio.create_task(start_agent_task(sess, task))
+
+# 起動処理中のタスク（参照を保持して GC を防ぐ）
+_STARTUP_TASKS: Set[asyncio.Task] = set()
+
+def spawn_agent(task: str, session_id: str) -> None:
+    # エージェント起動をレスポンスと切り離してバックグラウンドで実行
+    t = asyncio.create_task(run_agent(task, session_id))
+    _STARTUP_TASKS.add(t)
+    t.add_done_callback(_STARTUP_TASKS.discard)
 
 @app.post("/api/task", response_model=Dict[str, str])
-async def start_task(request: TaskRequest, background_tasks: BackgroundTasks):
+async def start_task(request: TaskRequest):
     # タスク開始エンドポイント
     session_id = request.session_id or str(uuid.uuid4())
-    background_tasks.add_task(run_agent, request.task, session_id)
+    spawn_agent(request.task, session_id)
     return {"status": "started", "session_id": session_id}
 
+def drain_queue(queue: asyncio.Queue, first: Dict[str, Any], limit: int = MAX_BATCH_SIZE) -> List[Dict[str, Any]]:
+    # 既にキューに溜まっているメッセージを待たずにまとめて取り出す
+    batch = [first]
+    while len(batch) < limit:
+        try:
+            batch.append(queue.get_nowait())
+        except asyncio.QueueEmpty:
+            break
+    return batch
+
+async def collect_batch(queue: asyncio.Queue, first: Dict[str, Any],
+                        window: float = WS_BATCH_WINDOW, limit: int = WS_MAX_BATCH_SIZE) -> List[Dict[str, Any]]:
+    # 短いデバウンス期間内に届いたメッセージも1フレームにまとめる
+    batch = drain_queue(queue, first, limit)
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + window
+    while len(batch) < limit:
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            break
+        try:
+            batch.append(await asyncio.wait_for(queue.get(), timeout=remaining))
+        except asyncio.TimeoutError:
+            break
+    return batch
+
 @app.get("/api/messages/{session_id}")
 async def get_messages(session_id: str):
-    # RESTでのポーリング取得 (未使用想定)
-    if session_id not in active_sessions:
+    # RESTでのポーリング取得 (未使用想定・WebSocket を推奨)
+    # 1リクエストで溜まっているメッセージをまとめて返す
+    sess = SESSIONS.get(session_id)
+    if sess is None:
         return {"status": "error", "message": "セッションが見つかりません"}
     try:
-        msg = await asyncio.wait_for(active_sessions[session_id].get(), timeout=30)
-        return {"status": "success", "message": msg}
+        first = await asyncio.wait_for(sess.out_q.get(), timeout=30)
     except asyncio.TimeoutError:
-        return {"status": "timeout", "message": None}
+        return {"status": "timeout", "messages": []}
+    return {"status": "success", "messages": drain_queue(sess.out_q, first)}
 
 @app.post("/api/response/{session_id}")
 async def submit_response(session_id: str, data: UserResponse):
     # ユーザー応答受け取り
-    if session_id not in user_response_queues:
+    sess = SESSIONS.get(session_id)
+    if sess is None:
         return {"status": "error", "message": "セッションが見つかりません"}
-    await user_response_queues[session_id].put(data.response)
+    await sess.in_q.put(data.response)
     return {"status": "success"}
 
+def stop_session_agent(sess: Session) -> bool:
+    # エージェントに停止を要求し、応答待ち等で止まっている実行タスクもキャンセルする
+    if sess.agent is None:
+        return False
+    sess.agent.stop()
+    if sess.task is not None:
+        sess.task.cancel()
+    return True
+
 @app.post("/api/stop/{session_id}")
 async def stop_agent(session_id: str):
     # タスク停止
-    agent = active_agents.get(session_id)
-    if agent:
-        agent.stop()
-        await active_sessions[session_id].put({
+    sess = SESSIONS.get(session_id)
+    if sess is not None and stop_session_agent(sess):
+        await sess.out_q.put({
             "type": "status",
             "content": "エージェントが停止されました"
         })
@@ -224,26 +339,22 @@ async def stop_agent(session_id: str):
 async def websocket_endpoint(websocket: WebSocket, session_id: str):
     # WebSocket エンドポイント
     await websocket.accept()
-    loop = asyncio.get_running_loop()
-    session_loops[session_id] = loop
-    active_sessions.setdefault(session_id, asyncio.Queue())
-    user_response_queues.setdefault(session_id, asyncio.Queue())
+    sess = get_session(session_id)
+    out_q, in_q = sess.out_q, sess.in_q
 
     async def recv():
         # フロントからの受信ハンドラ
         try:
             while True:
-                data = await websocket.receive_json()
+                data = loads(await websocket.receive_text())
                 t = data.get("type")
                 if t == "response":
-                    await user_response_queues[session_id].put(data.get("content", ""))
+                    await in_q.put(data.get("content", ""))
                 elif t == "task":
-                    asyncio.create_task(run_agent(data.get("content", ""), session_id))
+                    spawn_agent(data.get("content", ""), session_id)
                 elif t == "stop":
-                    ag = active_agents.get(session_id)
-                    if ag:
-                        ag.stop()
-                        await active_sessions[session_id].put({
+                    if stop_session_agent(sess):
+                        await out_q.put({
                             "type": "status",
                             "content": "エージェントが停止されました"
                         })
@@ -254,13 +365,44 @@ async def websocket_endpoint(websocket: WebSocket, session_id: str):
         # バックエンド→フロント送信ハンドラ
         try:
             while True:
-                msg = await active_sessions[session_id].get()
-                await websocket.send_json(msg)
+                msg = await out_q.get()
+                batch = await collect_batch(out_q, msg)
+                if len(batch) == 1:
+                    await websocket.send_text(dumps(msg))
+                else:
+                    # 複数溜まっている場合は1フレームにまとめて送信
+                    await websocket.send_text(dumps({"type": "batch", "items": batch}))
         except Exception:
             pass
 
-    # 並列実行
-    await asyncio.gather(recv(), send())
+    # 並列実行: どちらかが終了（切断・送信失敗）したらもう一方も止める
+    tasks = [asyncio.create_task(recv()), asyncio.create_task(send())]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        # 切断されたセッションの状態を破棄（エージェントも停止）
+        if SESSIONS.get(session_id) is sess:
+            stop_session_agent(sess)
+            del SESSIONS[session_id]
+
+def select_event_loop() -> str:
+    # uvloop（Windows では winloop）があれば明示的に使用し、無ければ asyncio 標準ループ
+    if sys.platform == "win32":
+        try:
+            import winloop
+        except ImportError:
+            return "asyncio"
+        # uvicorn は winloop を直接指定できないため、ポリシーとして設定する
+        asyncio.set_event_loop_policy(winloop.EventLoopPolicy())
+        return "none"
+    try:
+        import uvloop  # noqa: F401
+    except ImportError:
+        return "asyncio"
+    return "uvloop"
 
 @app.get("/")
 async def root():
@@ -273,5 +415,14 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Manus API Server")
     parser.add_argument("--port", type=int, default=8001, help="ポート番号")
     parser.add_argument("--host", type=str, default="0.0.0.0", help="バインドホスト")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("WORKERS", "1")),
+                        help="ワーカープロセス数（1 = 開発用シングルプロセス）")
     args = parser.parse_args()
-    uvicorn.run(app, host=args.host, port=args.port)
+    if args.workers > 1:
+        # セッションはワーカープロセス内に保持される。WebSocket は1接続で完結するため問題ないが、
+        # REST の /api/* を使う場合はロードバランサで session_id によるスティッキールーティングが必要
+        logger.info("ワーカー数 %d で起動します（REST API 利用時はスティッキーセッション必須）", args.workers)
+        uvicorn.run("api_server:app", host=args.host, port=args.port,
+                    workers=args.workers, loop=select_event_loop())
+    else:
+        uvicorn.run(app, host=args.host, port=args.port, loop=select_event_loop())
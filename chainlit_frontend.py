@@ -9,6 +9,8 @@ import chainlit as cl
 import websockets
 from typing import Dict, Any
 
+from core.json_utils import dumps, loads
+
 # ログ設定: INFOレベルで出力
 logging.basicConfig(
     level=logging.INFO,
@@ -51,41 +53,66 @@ async def connect_to_websocket(session_id: str) -> bool:
     await cl.Message(content="WebSocketへの接続に失敗しました。サーバーを確認してください。", author="Error").send()
     return False
 
+async def _handle_batch(connection: websockets.WebSocketClientProtocol, data: Dict[str, Any]):
+    # 複数メッセージをまとめたフレーム（各要素は解析済みのため再パースしない）
+    for item in data.get("items", ()):
+        await handle_message(connection, item)
+
+async def _handle_notify(connection: websockets.WebSocketClientProtocol, data: Dict[str, Any]):
+    # 通知メッセージ
+    await cl.Message(content=data.get("content", "")).send()
+
+async def _handle_ask(connection: websockets.WebSocketClientProtocol, data: Dict[str, Any]):
+    # ユーザーへの質問
+    await cl.Message(content=data.get("content", "")).send()
+    # ユーザーの回答を待ち、バックエンドに返送
+    response = await cl.AskUserMessage(content="").send()
+    logger.info("ユーザー応答: %s", response)
+    await connection.send(dumps({"type": "response", "content": response}))
+
+async def _handle_status(connection: websockets.WebSocketClientProtocol, data: Dict[str, Any]):
+    # ステータス更新
+    await cl.Message(content=data.get("content", ""), author="System").send()
+
+async def _handle_error(connection: websockets.WebSocketClientProtocol, data: Dict[str, Any]):
+    # エラー表示
+    await cl.Message(content=data.get("content", ""), author="Error").send()
+
+async def _handle_unknown(connection: websockets.WebSocketClientProtocol, data: Dict[str, Any]):
+    logger.warning("未知のメッセージタイプ: %s", data.get("type"))
+
+# メッセージタイプ → 表示ハンドラ
+HANDLERS = {
+    "batch": _handle_batch,
+    "notify": _handle_notify,
+    "ask": _handle_ask,
+    "status": _handle_status,
+    "error": _handle_error,
+}
+
+async def handle_message(connection: websockets.WebSocketClientProtocol, data: Dict[str, Any]):
+    """
+    バックエンドからの1メッセージをChainlitのUIに表示する。
+    """
+    await HANDLERS.get(data.get("type"), _handle_unknown)(connection, data)
+
 async def listen_for_messages(connection: websockets.WebSocketClientProtocol):
     """
     WebSocketからのメッセージを待ち受け、ChainlitのUIに表示する。
+    バックエンドとのやり取りは WebSocket を正とし、REST の /api/messages ポーリングは使用しない。
     """
+    recv = connection.recv
     try:
         while session_data["is_connected"]:
-            raw = await connection.recv()
-            logger.info(f"Raw WS フレーム受信: {raw}")
+            raw = await recv()
+            logger.debug("Raw WS フレーム受信: %s", raw)
             try:
-                data = json.loads(raw)
-                logger.info(f"Parsed Message: {data}")
-                msg_type = data.get("type")
-                content = data.get("content", "")
-
-                if msg_type == "notify":
-                    # 通知メッセージ
-                    await cl.Message(content=content).send()
-                elif msg_type == "ask":
-                    # ユーザーへの質問
-                    await cl.Message(content=content).send()
-                    # ユーザーの回答を待ち、バックエンドに返送
-                    response = await cl.AskUserMessage(content="").send()
-                    logger.info(f"ユーザー応答: {response}")
-                    await connection.send(json.dumps({"type": "response", "content": response}))
-                elif msg_type == "status":
-                    # ステータス更新
-                    await cl.Message(content=content, author="System").send()
-                elif msg_type == "error":
-                    # エラー表示
-                    await cl.Message(content=content, author="Error").send()
-                else:
-                    logger.warning(f"未知のメッセージタイプ: {msg_type}")
+                data = loads(raw)
             except json.JSONDecodeError:
-                logger.error(f"無効なJSONフォーマット: {raw}")
+                logger.error("無効なJSONフォーマット: %s", raw)
                 await cl.Message(content="無効なメッセージを受信しました。", author="Error").send()
+                continue
+            await handle_message(connection, data)
     except websockets.exceptions.ConnectionClosed:
         logger.warning("WebSocket接続が閉じられました。")
         session_data["is_connected"] = False
@@ -150,7 +177,7 @@ async def on_message(message: cl.Message):
 
     # タスクをWSで送信
     try:
-        await session_data["ws_connection"].send(json.dumps({"type": "task", "content": user_input}))
+        await session_data["ws_connection"].send(dumps({"type": "task", "content": user_input}))
     except Exception as e:
         logger.error(f"タスク送信エラー: {e}")
         await cl.Message(content=f"タスク送信エラー: {e}", author="Error").send()
@@ -169,8 +196,10 @@ async def on_stop_action(action: cl.Action):
     logger.info(f"停止リクエスト: セッションID={sid}")
     try:
         # WebSocketで停止命令を送信
-        await session_data["ws_connection"].send(json.dumps({"type": "stop"}))
+        await session_data["ws_connection"].send(dumps({"type": "stop"}))
         await cl.Message(content="停止リクエストを送信しました。", author="System").send()
     except Exception as e:
+        # WS 送信に失敗した時点で接続は切れているため REST での再送はせず、次回操作で再接続させる
         logger.error(f"停止エラー: {e}")
         await cl.Message(content=f"停止中にエラーが発生しました: {e}", author="Error").send()
+        session_data["is_connected"] = False
@@ -7,8 +7,15 @@ Manus ライクなエージェントの中心クラス。UI をブロックし
 
 主な特徴
 --------
-* start / stop の外部 API は同期のまま。内部で asyncio.run しているだけなので呼び出し側の変更は不要。
+* start / stop の外部 API は同期のまま。内部ではエージェントごとの asyncio.Runner を使い回すので
+  呼び出しのたびにイベントループや executor を作り直さない。呼び出し側の変更は不要。
+  ループは実行中でない時の stop() か close() で閉じる。
+* 既にイベントループ上にいる呼び出し側（API サーバー等）は astart を直接 await できる。
+* コルーチン関数として登録されたツールはスレッドを介さずループ上で直接実行する。
 * 各ツール実行を asyncio.wait_for でタイムアウト制御。秒数は CONFIG["agent_loop"]["tool_timeout_seconds"]。
+  ユーザー応答を待つ message_ask_user はハンドラ側の待ち時間に任せ、タイムアウトを掛けない。
+* LLM が {"calls": [...]} で複数ツールを返した場合は asyncio.gather で並列実行（同時数は tool_concurrency）。
+  ブラウザ・サンドボックスなど状態を共有するツールは資源ごとのロックで呼び出し順に直列化する。
 * stop() で _cancel_event をセットし、ループ内 await ポイントで即時キャンセル。
 * タスクごとの進捗やコンテキスト要約など旧版のロジックは保持。
 * Plan ↔ todo.md 同期対応
@@ -18,22 +25,33 @@ Manus ライクなエージェントの中心クラス。UI をブロックし
 from __future__ import annotations
 
 import asyncio
+import contextlib
+import copy
 import functools
+from concurrent.futures import ThreadPoolExecutor
 import hashlib
-import json
 from core.logging_config import logger
 import os
 import re
+import threading
 import time
+from collections import OrderedDict
 from pathlib import Path
-from typing import Any, Dict, Optional, List
+from typing import TYPE_CHECKING, Any, Dict, Optional, List
+
+try:
+    import aiofiles
+except ImportError:  # aiofiles が無い環境ではスレッドプール経由で書き込む
+    aiofiles = None
 
 from config import CONFIG
 from tools.tool_registry import ToolRegistry
 from .context import Context
-from .enhanced_memory import EnhancedMemory
+from .json_utils import dumps as _dumps
 from .memory import Memory
-from .planner import Planner
+
+if TYPE_CHECKING:
+    from .planner import Planner
 
 
 # ---------------------------------------------------------------------------
@@ -43,6 +61,7 @@ from .planner import Planner
 def _to_thread(func, *args, **kwargs):
     """
     同期関数 `func` をデフォルト executor で実行し await 可能にする。
+    同期ツールも ToolRegistry.execute_tool_async から同じ executor で実行される。
     kwargs がある場合は functools.partial で包む。
     """
     loop = asyncio.get_running_loop()
@@ -52,6 +71,103 @@ def _to_thread(func, *args, **kwargs):
     return loop.run_in_executor(None, func, *args)
 
 
+# 計画ステップ行「1. xxx」と todo.md の完了行「- [x] 1.」（行頭のみ・改行はまたがない）
+_STEP_RE = re.compile(r"^(\d+)\.[^\S\n]+(.*)", re.MULTILINE)
+_DONE_RE = re.compile(r"^- \[x\] (\d+)\.", re.MULTILINE)
+
+# 同一プロンプトに対する LLM 応答キャッシュの最大件数
+_RESPONSE_CACHE_SIZE = 256
+
+# エージェント自身の進捗通知はこの秒数だけ待ってまとめて1回で送る
+_NOTIFY_DEBOUNCE_SECONDS = 0.25
+
+# ユーザーの応答待ちなど、自前で待ち時間を管理するためツールタイムアウトを掛けないツール
+_UNTIMED_TOOLS = frozenset({"message_ask_user"})
+
+# 状態を共有するツール群（接頭辞 → 資源名）。同じ資源を使う呼び出しは並列バッチ内でも1つずつ順に実行する。
+# browser_* は現在のページ、シェル・ファイル・コード実行・デプロイは同じサンドボックスを共有している。
+_TOOL_RESOURCES = (
+    ("browser_", "browser"),
+    ("shell_", "sandbox"),
+    ("file_", "sandbox"),
+    ("code_", "sandbox"),
+    ("codeact_", "sandbox"),
+    ("deploy_", "sandbox"),
+    ("message_", "message"),
+)
+
+
+def _tool_resource(name: str) -> Optional[str]:
+    """ツールが共有する資源名を返す。状態を持たないツール（検索など）は None。"""
+    for prefix, resource in _TOOL_RESOURCES:
+        if name.startswith(prefix):
+            return resource
+    return None
+
+
+# ---------------------------------------------------------------------------
+# プロンプトテンプレート（静的部分は毎回組み立てない）
+# ---------------------------------------------------------------------------
+
+_PROMPT_EVENTS_HEADER = "==== イベントストリーム ====\n"
+
+_PROMPT_MEMORY_HEADER = "\n\n==== メモリ状態 ====\n"
+
+_PROMPT_SUFFIX_TEMPLATE = (
+    "\n\n利用可能なツール: {tools}\n"
+    "次のアクションとして原則 1 つだけツールを JSON 形式で呼び出してください。\n"
+    "フォーマット:\n```json\n{{\"name\": <tool_name>, \"parameters\": {{...}}}}\n```\n"
+    "互いに依存しない複数のツールを同時に実行する場合に限り、次の形式も使用できます:\n"
+    "```json\n{{\"calls\": [{{\"name\": <tool_name>, \"parameters\": {{...}}}}, ...]}}\n```\n"
+    "同じブラウザやサンドボックスを使うツールは呼び出し順に1つずつ実行されます。"
+    "複数の URL を並列に取得する場合は browser_navigate_many を使ってください。\n"
+    "\n<会話ガイドライン>\n"
+    "* ユーザーの回答を受け取った後は、回答の確認は一度だけにしてください\n"
+    "* 同じような通知メッセージを繰り返し送らないでください\n"
+    "* 次のステップに関する質問は message_ask_user で行ってください\n"
+    "</会話ガイドライン>\n"
+)
+
+# イベント種別 → プロンプト用の1行整形関数
+_EVENT_FORMATTERS = {
+    "Message": lambda ev: f"ユーザー: {ev['content']}\n",
+    "Plan": lambda ev: f"計画:\n{ev['content']}\n",
+    "Action": lambda ev: f"アクション呼び出し: {_dumps(ev['content'])}\n",
+    "Observation": lambda ev: f"観察: {str(ev.get('content', ''))}\n",
+    "Summary": lambda ev: f"要約: {ev['content']}\n",
+}
+
+def _preview(value: Any, limit: int) -> str:
+    """文字列化は1回だけ行い、limit を超える場合のみ切り詰めて "..." を付ける。"""
+    text = value if isinstance(value, str) else str(value)
+    return text if len(text) <= limit else text[:limit] + "..."
+
+
+# 要約用プロンプトでのイベント整形（長い内容は先頭だけ）
+_SUMMARY_FORMATTERS = {
+    "Message": lambda ev: f"ユーザー: {ev['content']}\n",
+    "Plan": lambda ev: f"計画: {_preview(ev['content'], 200)}\n",
+    "Action": lambda ev: f"アクション: {_dumps(ev['content'])}\n",
+    "Observation": lambda ev: f"観察: {_preview(ev.get('content', ''), 100)}\n",
+}
+
+# 重複していれば要約せずに捨ててよいイベント種別（ユーザー発言・計画・要約は常に残す）
+_DEDUP_EVENT_TYPES = frozenset({"Action", "Observation"})
+
+_FLOW_GUIDANCE = (
+    "\n<会話フローガイダンス>\n"
+    "ユーザーはすでに質問に回答しており、通知で確認済みです。\n"
+    "次のステップに進み、同じ内容の通知を繰り返さず、message_ask_user で次の質問を行ってください。\n"
+    "</会話フローガイダンス>\n"
+)
+
+_ANSWERED_STATE = (
+    "\n<会話状態>\n"
+    "ユーザーが質問に回答したところです。この回答を確認した後、message_ask_user で次の質問に進んでください。\n"
+    "</会話状態>\n"
+)
+
+
 # ---------------------------------------------------------------------------
 # Agent クラス
 # ---------------------------------------------------------------------------
@@ -70,142 +186,329 @@ class Agent:
         self.llm_client = llm_client
         self.system_prompt = system_prompt
         self.tool_registry = tool_registry
-        self.planner = planner or Planner(llm_client)
+        if planner is None:
+            from .planner import Planner
+            planner = Planner(llm_client)
+        self.planner = planner
 
         # メモリ
         if memory is not None:
             self.memory = memory
         else:
             if CONFIG["memory"].get("use_vector_memory", False):
+                # ベクトルメモリは埋め込みモデル等の重い依存を持つため使う場合のみインポート
+                from .enhanced_memory import EnhancedMemory
                 self.memory = EnhancedMemory(Path(CONFIG["system"]["workspace_dir"]).as_posix())
             else:
                 self.memory = Memory(workspace_dir=CONFIG["system"]["workspace_dir"])
 
-        self.context = Context()
+        # ループ中に毎回参照する設定値は初期化時に束縛しておく
+        llm_cfg = CONFIG["llm"]
+        self._llm_temperature: float = llm_cfg["temperature"]
+        self._llm_max_tokens: int = llm_cfg["max_tokens"]
+        # temperature 0 なら同じプロンプトには同じ応答が返るので、完全一致の応答をキャッシュする
+        self._response_cache: Optional[OrderedDict[bytes, Any]] = (
+            OrderedDict() if self._llm_temperature == 0 else None
+        )
+        loop_cfg = CONFIG["agent_loop"]
+        self._max_iterations: int = loop_cfg["max_iterations"]
+        self._max_seconds: int = loop_cfg["max_time_seconds"]
+        self._summarize_every: int = loop_cfg["auto_summarize_threshold"]
+        self._tool_timeout: int = loop_cfg.get("tool_timeout_seconds", 90)
+        self._tool_concurrency: int = max(1, loop_cfg.get("tool_concurrency", 4))
+        self._max_observation_chars: int = loop_cfg.get("max_observation_chars", 20000)
+        self._keep_full_observations: bool = CONFIG["memory"].get("keep_full_observations", True)
+
+        # 固定部分（システムプロンプト + ツール一覧・出力形式）は system メッセージにまとめ、
+        # 毎回同じ先頭部分を送ることでプロバイダ側のプレフィックスキャッシュを効かせる
+        # ツール構成はほぼ不変なので初期化時に組み立てておく（以後はレジストリ変更時のみ作り直す）
+        self._prompt_tools: Optional[str] = None
+        self._system_message = system_prompt
+        self._system_hash = hashlib.blake2b(digest_size=16)  # 応答キャッシュ用の接頭部ハッシュ
+        self._get_system_message()
+
+        # メモリ更新はバックグラウンドで行う（次の LLM 呼び出しと重ねる）
+        self._memory_lock = threading.Lock()
+        # 要約済みイベントの描画文字列ハッシュ（重複ばかりなら要約の LLM 呼び出しを省く）
+        self._summarized_hashes: set[bytes] = set()
+        self._deferred_memory_updates: List[tuple] = []
+        self._pending_memory: set[asyncio.Task] = set()
+
+        # イベントのプロンプト用文字列は追加時に一度だけ生成する
+        self.context = Context(renderer=self._format_event)
         self._cancel_event: Optional[asyncio.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
         self._loop_task: Optional[asyncio.Task] = None
+        self._runner: Optional[asyncio.Runner] = None
         self._start_time: float = 0.0
         self._iterations: int = 0
 
         # Plan ↔ todo 同期用
         self._plan_hash: str = ""
+        # 最新の Plan イベントと、todo.md に反映済みの Plan イベントの id()
+        self._plan_event: Optional[Dict[str, Any]] = None
+        self._synced_plan_id: Optional[int] = None
         self._todo_path = Path(CONFIG["system"]["workspace_dir"]) / CONFIG["memory"]["todo_file"]
+        # todo.md の完了済みステップ番号（ファイルの mtime/サイズが変わるまで再読込しない）
+        self._todo_stat_key: Optional[tuple] = None
+        self._todo_completed: frozenset[str] = frozenset()
         
         # 会話状態管理用
         self._last_tool_call: Optional[Dict[str, Any]] = None
         self._recent_notifications: List[str] = []  # 最近の通知メッセージを追跡
+        # 進捗通知のバッファと送信タスク（_notify 参照）
+        self._pending_notices: List[str] = []
+        self._notice_task: Optional[asyncio.Task] = None
 
     # ------------------------------------------------------------------ #
     # 公開 API
     # ------------------------------------------------------------------ #
     def start(self, user_input: str) -> None:
-        asyncio.run(self._start_async(user_input))
+        """同期呼び出し用。イベントループ上からは astart を await すること。"""
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            pass
+        else:
+            raise RuntimeError("実行中のイベントループ内では start() ではなく await agent.astart() を使用してください")
+        if self._runner is None:
+            # ループと既定 executor は次回の start でも再利用し、close() でまとめて閉じる。
+            # executor は並列ツール実行の上限に LLM 呼び出しとメモリ更新の分を足した大きさ
+            self._runner = asyncio.Runner()
+            self._runner.get_loop().set_default_executor(
+                ThreadPoolExecutor(max_workers=self._tool_concurrency + 2, thread_name_prefix="agent")
+            )
+        self._runner.run(self._start_async(user_input))
+
+    async def astart(self, user_input: str) -> None:
+        """実行中のイベントループ上でタスクを処理する（FastAPI・Jupyter 等から await する）。"""
+        await self._start_async(user_input)
+
+    start_async = astart  # 旧名（互換性のため残す）
 
     def stop(self) -> None:
-        if self._cancel_event is not None:
+        runner = self._runner
+        if runner is not None and not runner.get_loop().is_running():
+            # start() 用のループが待機中なら、停止ついでにループと executor も解放する
+            self.close()
+        if self._cancel_event is None:
+            return
+        # UI スレッド等ループ外から呼ばれた場合は Future を作らずにループへ set を投げる
+        loop = self._loop
+        if loop is not None and loop.is_running() and not self._on_loop(loop):
+            loop.call_soon_threadsafe(self._cancel_event.set)
+        else:
             self._cancel_event.set()
 
+    def close(self) -> None:
+        """start() 用のイベントループと executor を閉じる。次の start() では作り直す。"""
+        runner, self._runner = self._runner, None
+        if runner is not None:
+            runner.close()
+
+    @staticmethod
+    def _on_loop(loop: asyncio.AbstractEventLoop) -> bool:
+        try:
+            return asyncio.get_running_loop() is loop
+        except RuntimeError:
+            return False
+
     # ------------------------------------------------------------------ #
     # 内部処理
     # ------------------------------------------------------------------ #
     async def _start_async(self, user_input: str) -> None:
         self._cancel_event = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
         self._start_time = time.time()
         self._iterations = 0
         self._recent_notifications = []
 
         self.context.add_event({"type": "Message", "content": user_input})
-        await self._safe_tool("message_notify_user", {"message": "リクエストを受け付けました。計画を立案します。"})
+        self._notify("リクエストを受け付けました。計画を立案します。")
 
         plan_text: str = await _to_thread(self.planner.create_plan, user_input)
-        self.context.add_event({"type": "Plan", "content": plan_text})
-        self._plan_hash = self._hash(plan_text)
-        await _to_thread(self._write_todo_from_plan, plan_text, preserve_completed=False)
+        self._add_plan_event(plan_text)
+        self._synced_plan_id = id(self._plan_event)
+        self._plan_hash = self._plan_event["_hash"]
+        await self._write_todo_from_plan(plan_text, preserve_completed=False)
 
         self._loop_task = asyncio.create_task(self._agent_loop_async())
-        await self._loop_task
+        try:
+            await self._loop_task
+        finally:
+            await self._flush_notifications()
 
     async def _agent_loop_async(self) -> None:
-        cfg = CONFIG["agent_loop"]
-        max_iter = cfg["max_iterations"]
-        max_seconds = cfg["max_time_seconds"]
-        summarize_every = cfg["auto_summarize_threshold"]
-        tool_timeout = cfg.get("tool_timeout_seconds", 90)
-
-        while not self._cancel_event.is_set() and self._iterations < max_iter:
+        max_iter = self._max_iterations
+        max_seconds = self._max_seconds
+        summarize_every = self._summarize_every
+        tool_timeout = self._tool_timeout
+
+        # ループ内で繰り返し参照する属性はローカルに束縛しておく
+        is_cancelled = self._cancel_event.is_set
+        add_event = self.context.add_event
+        build_prompt = self._build_prompt
+        get_response = self._get_llm_response
+        extract = self._extract_tool_calls
+        run_tool = self._run_tool
+        record = self._record_observation
+        semaphore = asyncio.Semaphore(self._tool_concurrency)
+        locks = {resource: asyncio.Lock() for _, resource in _TOOL_RESOURCES}
+
+        while not is_cancelled() and self._iterations < max_iter:
             if time.time() - self._start_time > max_seconds:
-                await self._safe_tool("message_notify_user", {"message": "時間上限を超過したため終了します。"})
+                self._notify("時間上限を超過したため終了します。")
                 break
 
             self._iterations += 1
 
             # Plan ↔ todo 同期
-            await _to_thread(self._sync_todo_with_latest_plan)
+            await self._sync_todo_with_latest_plan()
+
+            # 前回の観察によるメモリ更新（todo 同期の間に進めていたもの）を反映しきってからプロンプトを作る
+            await self._flush_memory_updates()
 
             # コンテキスト要約
             if summarize_every and self._iterations % summarize_every == 0:
                 await _to_thread(self._summarize_context)
 
-            # プロンプト生成とLLM呼び出し
-            prompt = await _to_thread(self._build_prompt)
-            llm_resp = await _to_thread(self._get_llm_response, prompt)
-            tool_call = await _to_thread(self._extract_tool_call, llm_resp)
+            # プロンプト生成とLLM呼び出し（抽出は軽量なのでループ上で行う）
+            prompt = await _to_thread(build_prompt)
+            llm_resp = await _to_thread(get_response, prompt)
+            tool_calls = extract(llm_resp)
 
-            if tool_call is None:
-                self.context.add_event({"type": "Observation", "content": "ツール呼び出し抽出失敗"})
+            if not tool_calls:
+                add_event({"type": "Observation", "content": "ツール呼び出し抽出失敗"})
                 continue
 
-            if tool_call["name"] == "idle":
-                await self._safe_tool("message_notify_user", {"message": "タスクが完了しました。"})
+            finished = False
+            runnable: List[Dict[str, Any]] = []
+            for tool_call in tool_calls:
+                if tool_call["name"] == "idle":
+                    finished = True
+                    continue
+
+                # ツール実行を記録
+                self._last_tool_call = tool_call
+                add_event({"type": "Action", "content": tool_call})
+
+                # message_notify_userの繰り返しを検出
+                if tool_call["name"] == "message_notify_user" and self._is_repetitive_notification(tool_call):
+                    logger.warning("繰り返しの通知メッセージを検出しました。次の質問に進むようにガイダンスを追加します。")
+                    # 次回のループで質問を促すガイダンスが追加される
+                    continue
+                runnable.append(tool_call)
+
+            if len(runnable) == 1:
+                results = [await run_tool(runnable[0], tool_timeout, semaphore, locks)]
+            elif runnable:
+                # 独立したツール呼び出しは並列に実行し、結果は呼び出し順に記録する。
+                # 同じ資源を使う呼び出し同士はロック（FIFO）で呼び出し順に1つずつ実行される
+                results = await asyncio.gather(*(run_tool(c, tool_timeout, semaphore, locks) for c in runnable))
+            else:
+                results = []
+
+            for tool_call, result in zip(runnable, results):
+                # 巨大な出力はコンテキストに入れる時点で切り詰める（以降の描画・要約も軽くなる）
+                clipped = self._clip_observation(result)
+                record(tool_call, clipped)
+                self._deferred_memory_updates.append(
+                    (tool_call, result if self._keep_full_observations else clipped)
+                )
+            # メモリ反映はバックグラウンドで始め、次のプロンプト生成の直前に完了を待つ
+            self._schedule_memory_updates()
+
+            if finished:
+                self._notify("タスクが完了しました。")
                 break
 
-            # ツール実行を記録
-            self._last_tool_call = tool_call
-            self.context.add_event({"type": "Action", "content": tool_call})
+        await self._flush_memory_updates()
 
-            # message_notify_userの繰り返しを検出
-            if tool_call["name"] == "message_notify_user" and self._is_repetitive_notification(tool_call):
-                logger.warning("繰り返しの通知メッセージを検出しました。次の質問に進むようにガイダンスを追加します。")
-                # 次回のループで質問を促すガイダンスが追加される
-                continue
+        if is_cancelled():
+            self._notify("ユーザーにより停止しました。")
+        else:
+            self._report_progress(True)
 
+    def _schedule_memory_updates(self) -> None:
+        """溜まっている観察のメモリ反映をバックグラウンドタスクとして開始する。"""
+        if not self._deferred_memory_updates:
+            return
+        updates, self._deferred_memory_updates = self._deferred_memory_updates, []
+        task = asyncio.create_task(_to_thread(self._apply_memory_updates, updates))
+        self._pending_memory.add(task)
+        task.add_done_callback(self._pending_memory.discard)
+
+    async def _flush_memory_updates(self) -> None:
+        """未反映・反映中のメモリ更新をすべて完了させる（プロンプト生成前・終了時）。"""
+        self._schedule_memory_updates()
+        if self._pending_memory:
+            await asyncio.gather(*self._pending_memory, return_exceptions=True)
+
+    def _apply_memory_updates(self, updates: List[tuple]) -> None:
+        # 呼び出し順を保ったまま反映する。get_relevant_state とはロックで排他
+        with self._memory_lock:
+            for tool_call, result in updates:
+                try:
+                    self.memory.update_from_observation(tool_call, result)
+                except Exception as exc:
+                    logger.error(f"メモリ更新失敗: {exc}")
+
+    async def _run_tool(
+        self,
+        tool_call: Dict[str, Any],
+        timeout: float,
+        semaphore: asyncio.Semaphore,
+        locks: Dict[str, asyncio.Lock],
+    ) -> Any:
+        """ツールを1つ実行する。タイムアウト・例外は観察結果の文字列に変換する。"""
+        name = tool_call["name"]
+        resource = _tool_resource(name)
+        # 資源ロックを先に取り、順番待ちの間は同時実行枠を占有しない
+        async with locks[resource] if resource else contextlib.nullcontext(), semaphore:
             try:
-                result = await asyncio.wait_for(
-                    _to_thread(self.tool_registry.execute_tool, tool_call["name"], tool_call.get("parameters", {})),
-                    timeout=tool_timeout,
+                return await asyncio.wait_for(
+                    self.tool_registry.execute_tool_async(name, tool_call.get("parameters", {})),
+                    timeout=None if name in _UNTIMED_TOOLS else timeout,
                 )
             except asyncio.TimeoutError:
-                result = f"ツール {tool_call['name']} が {tool_timeout} 秒でタイムアウトしました。"
+                return f"ツール {name} が {timeout} 秒でタイムアウトしました。"
             except Exception as exc:
-                result = f"ツール実行エラー: {exc}"
-
-            # ツールに応じた特別な処理
-            if tool_call["name"] == "message_ask_user":
-                # ユーザーの応答をMessageイベントとして追加
-                self.context.add_event({"type": "Message", "content": result})
-                # 通常の観察結果としても追加（一貫性のため）
-                self.context.add_event({"type": "Observation", "tool": tool_call["name"], "content": f"ユーザーの回答: {result}"})
-                # 通知メッセージ履歴をクリア（状態が変わったため）
-                self._recent_notifications.clear()
-            elif tool_call["name"] == "message_notify_user":
-                # 通知メッセージを記録
-                if "message" in tool_call.get("parameters", {}):
-                    self._recent_notifications.append(tool_call["parameters"]["message"])
-                    # 最大5件まで記録
-                    if len(self._recent_notifications) > 5:
-                        self._recent_notifications.pop(0)
-                # 通常の観察結果を追加
-                self.context.add_event({"type": "Observation", "tool": tool_call["name"], "content": result})
-            else:
-                # その他のツールの観察結果を追加
-                self.context.add_event({"type": "Observation", "tool": tool_call["name"], "content": result})
-
-            await _to_thread(self.memory.update_from_observation, tool_call, result)
-
-        if self._cancel_event.is_set():
-            await self._safe_tool("message_notify_user", {"message": "ユーザーにより停止しました。"})
+                return f"ツール実行エラー: {exc}"
+
+    def _clip_observation(self, result: Any) -> Any:
+        """文字列化して max_observation_chars を超える結果だけを切り詰める（0 以下なら無制限）。"""
+        limit = self._max_observation_chars
+        if limit <= 0:
+            return result
+        text = result if isinstance(result, str) else str(result)
+        if len(text) <= limit:
+            return result
+        return f"{text[:limit]}...[truncated {len(text) - limit} chars]"
+
+    def _record_observation(self, tool_call: Dict[str, Any], result: Any) -> None:
+        """ツールの実行結果をツールの種類に応じてコンテキストへ追加する。"""
+        name = tool_call["name"]
+        params = tool_call.get("parameters", {})
+        add_event = self.context.add_event
+        if name == "message_ask_user":
+            # ユーザーの応答をMessageイベントとして追加
+            add_event({"type": "Message", "content": result})
+            # 通常の観察結果としても追加（一貫性のため）
+            add_event({"type": "Observation", "tool": name, "content": f"ユーザーの回答: {result}"})
+            # 通知メッセージ履歴をクリア（状態が変わったため）
+            self._recent_notifications.clear()
+        elif name == "message_notify_user":
+            # 通知メッセージを記録
+            if "message" in params:
+                self._recent_notifications.append(params["message"])
+                # 最大5件まで記録
+                if len(self._recent_notifications) > 5:
+                    self._recent_notifications.pop(0)
+            # 通常の観察結果を追加
+            add_event({"type": "Observation", "tool": name, "content": result})
         else:
-            await _to_thread(self._report_progress, True)
+            # その他のツールの観察結果を追加
+            add_event({"type": "Observation", "tool": name, "content": result})
 
     def _is_repetitive_notification(self, tool_call: Dict[str, Any]) -> bool:
         """
@@ -251,71 +554,128 @@ class Agent:
     def _hash(self, txt: str) -> str:
         return hashlib.sha256(txt.encode("utf-8")).hexdigest()
 
-    def _latest_plan_text(self) -> Optional[str]:
-        for ev in reversed(self.context.get_events()):
-            if ev["type"] == "Plan":
-                return ev["content"]
-        return None
-
-    def _sync_todo_with_latest_plan(self) -> None:
-        plan_text = self._latest_plan_text()
-        if plan_text is None:
-            return
-        new_hash = self._hash(plan_text)
+    def _add_plan_event(self, plan_text: str) -> None:
+        """Plan イベントを追加し、同期判定用に参照とハッシュを保持する（Plan は必ずここから追加する）。"""
+        self._plan_event = {"type": "Plan", "content": plan_text, "_hash": self._hash(plan_text)}
+        self.context.add_event(self._plan_event)
+
+    async def _sync_todo_with_latest_plan(self) -> None:
+        ev = self._plan_event
+        if ev is None or id(ev) == self._synced_plan_id:
+            return  # 前回から Plan イベントが追加されていない（走査・ハッシュ不要）
+        self._synced_plan_id = id(ev)
+        new_hash = ev["_hash"]  # 追加時に計算済み
         if new_hash == self._plan_hash:
             return  # 変更なし
         # 計画が変わった → todo 再構築
-        self._write_todo_from_plan(plan_text, preserve_completed=True)
+        await self._write_todo_from_plan(ev["content"], preserve_completed=True)
         self._plan_hash = new_hash
         logger.info("Plan が更新されたため todo.md を再構築しました")
 
-    def _write_todo_from_plan(self, plan_text: str, *, preserve_completed: bool) -> None:
-        lines = plan_text.split("\n")
-        step_lines = []
-        for line in lines:
-            m = re.match(r"(\d+)\.\s+(.*)", line)
-            if m:
-                step_lines.append((m.group(1), m.group(2)))
+    async def _write_todo_from_plan(self, plan_text: str, *, preserve_completed: bool) -> None:
+        step_lines = _STEP_RE.findall(plan_text)
         if not step_lines:
             return
 
-        completed: set[str] = set()
-        if preserve_completed and self._todo_path.exists():
-            for l in self._todo_path.read_text(encoding="utf-8").split("\n"):
-                m = re.match(r"- \[x\] (\d+)\.", l)
-                if m:
-                    completed.add(m.group(1))
+        completed = await self._completed_todo_steps() if preserve_completed else frozenset()
+        content = "# タスク ToDo リスト\n\n" + "".join(
+            f"- [{'x' if num in completed else ' '}] {num}. {text}\n" for num, text in step_lines
+        )
+
+        # 一時ファイルに書いてから置き換える（途中状態の todo.md を読ませない）
+        tmp_path = self._todo_path.with_name(self._todo_path.name + ".tmp")
+        if aiofiles is not None:
+            async with aiofiles.open(tmp_path, "w", encoding="utf-8") as f:
+                await f.write(content)
+        else:
+            await _to_thread(tmp_path.write_text, content, encoding="utf-8")
+        os.replace(tmp_path, self._todo_path)
+
+        # 書いた内容の完了状態はわかっているので次回の読み直しを省く
+        st = os.stat(self._todo_path)
+        self._todo_stat_key = (st.st_mtime_ns, st.st_size)
+        self._todo_completed = frozenset(num for num, _ in step_lines if num in completed)
 
-        with self._todo_path.open("w", encoding="utf-8") as f:
-            f.write("# タスク ToDo リスト\n\n")
-            for num, text in step_lines:
-                mark = "x" if num in completed else " "
-                f.write(f"- [{mark}] {num}. {text}\n")
+    async def _completed_todo_steps(self) -> frozenset[str]:
+        """todo.md 上の完了済みステップ番号。ツールがファイルを書き換えた時だけ読み直す。"""
+        try:
+            st = os.stat(self._todo_path)
+        except FileNotFoundError:
+            return frozenset()
+        key = (st.st_mtime_ns, st.st_size)
+        if key != self._todo_stat_key:
+            if aiofiles is not None:
+                async with aiofiles.open(self._todo_path, "r", encoding="utf-8") as f:
+                    text = await f.read()
+            else:
+                text = await _to_thread(self._todo_path.read_text, encoding="utf-8")
+            self._todo_completed = frozenset(_DONE_RE.findall(text))
+            self._todo_stat_key = key
+        return self._todo_completed
 
     # ------------------------------------------------------------------ #
     # ユーティリティ（通知・要約・プロンプト生成など）
     # ------------------------------------------------------------------ #
     async def _safe_tool(self, name: str, params: Dict[str, Any]):
         try:
-            await _to_thread(self.tool_registry.execute_tool, name, params)
+            await self.tool_registry.execute_tool_async(name, params)
         except Exception as exc:
             logger.error(f"通知ツール {name} 失敗: {exc}")
 
+    def _notify(self, message: str) -> None:
+        """進捗通知をバッファに積む。短時間に続いた通知は1回の message_notify_user にまとめる。"""
+        self._pending_notices.append(message)
+        if self._notice_task is None or self._notice_task.done():
+            self._notice_task = asyncio.create_task(self._send_notices())
+
+    async def _send_notices(self) -> None:
+        # 送信中に積まれた通知も同じタスクで続けて送る
+        while self._pending_notices:
+            await asyncio.sleep(_NOTIFY_DEBOUNCE_SECONDS)
+            notices, self._pending_notices = self._pending_notices, []
+            await self._safe_tool("message_notify_user", {"message": "\n".join(notices)})
+
+    async def _flush_notifications(self) -> None:
+        """未送信の通知を送り終えるまで待つ（タスク終了時）。"""
+        task = self._notice_task
+        if task is not None and not task.done():
+            await task
+        if self._pending_notices:
+            await self._send_notices()
+
     def _summarize_context(self) -> None:
         events = self.context.get_events()
         if len(events) < 10:
             return
         recent, older = events[-10:], events[:-10]
-        summary_prompt = "以下のイベントを簡潔に日本語で要約してください。\n\n"
+
+        # 前回の要約以降に増えた内容がほぼ同じアクション・観察の繰り返しなら、
+        # LLM で要約せず重複イベントを取り除くだけにする
+        seen = set(self._summarized_hashes)
+        kept: List[Dict[str, Any]] = []
+        new_count = 0
         for ev in older:
-            if ev["type"] == "Message":
-                summary_prompt += f"ユーザー: {ev['content']}\n"
-            elif ev["type"] == "Plan":
-                summary_prompt += f"計画: {ev['content'][:200]}...\n"
-            elif ev["type"] == "Action":
-                summary_prompt += f"アクション: {json.dumps(ev['content'], ensure_ascii=False)}\n"
-            elif ev["type"] == "Observation":
-                summary_prompt += f"観察: {str(ev.get('content', ''))[:100]}...\n"
+            digest = hashlib.blake2b(ev.get("_rendered", "").encode("utf-8"), digest_size=16).digest()
+            if digest in seen:
+                if ev["type"] in _DEDUP_EVENT_TYPES:
+                    continue
+            else:
+                seen.add(digest)
+                new_count += 1
+            kept.append(ev)
+        if new_count < self._summarize_every / 2:
+            if len(kept) < len(older):
+                self.context.clear()
+                for ev in kept + recent:
+                    self.context.add_event(ev)
+                logger.info(f"新しいイベントが少ないため要約を省略し、重複 {len(older) - len(kept)} 件を削除しました")
+            return
+        self._summarized_hashes = seen
+
+        formatters = _SUMMARY_FORMATTERS
+        summary_prompt = "以下のイベントを簡潔に日本語で要約してください。\n\n" + "".join([
+            formatters[ev["type"]](ev) for ev in older if ev["type"] in formatters
+        ])
         summary, _ = self.llm_client.chat_completion(
             messages=[
                 {"role": "system", "content": "あなたは要約アシスタントです。重要点のみ抽出してください。"},
@@ -329,95 +689,122 @@ class Agent:
         for ev in recent:
             self.context.add_event(ev)
 
-    def _report_progress(self, is_final: bool = False):
+    def _report_progress(self, is_final: bool = False) -> None:
         elapsed = time.time() - self._start_time
         m, s = divmod(int(elapsed), 60)
         prefix = "最終レポート" if is_final else "途中経過"
-        msg = f"{prefix} – 経過時間: {m}分{s}秒, イテレーション: {self._iterations} 回"
-        self.tool_registry.execute_tool("message_notify_user", {"message": msg})
+        self._notify(f"{prefix} – 経過時間: {m}分{s}秒, イテレーション: {self._iterations} 回")
+
+    @staticmethod
+    def _format_event(ev: Dict[str, Any]) -> str:
+        fmt = _EVENT_FORMATTERS.get(ev["type"])
+        return fmt(ev) if fmt is not None else ""
 
     def _build_prompt(self) -> str:
         """
         コンテキストとメモリ状態に基づいてプロンプトを構築します。
         会話の流れを改善するためのガイダンスも追加します。
         """
-        events_text = ""
+        events = self.context.get_events()
+        parts = [self.context.get_text()]
+
+        # 会話フロー判定用の集計
         last_user_message = None
         last_action_type = None
         user_responses_count = 0
-        notify_after_user_message = False
-        
-        # イベントの分析
-        for i, ev in enumerate(self.context.get_events()):
+        for ev in events:
             if ev["type"] == "Message":
-                events_text += f"ユーザー: {ev['content']}\n"
-                last_user_message = ev['content']
+                last_user_message = ev["content"]
                 user_responses_count += 1
-                
-                # ユーザーメッセージの後に通知が来たかチェック
-                if i + 1 < len(self.context.get_events()) and \
-                   self.context.get_events()[i + 1]["type"] == "Action" and \
-                   self.context.get_events()[i + 1].get("content", {}).get("name") == "message_notify_user":
-                    notify_after_user_message = True
-                
-            elif ev["type"] == "Plan":
-                events_text += f"計画:\n{ev['content']}\n"
             elif ev["type"] == "Action":
-                events_text += f"アクション呼び出し: {json.dumps(ev['content'], ensure_ascii=False)}\n"
                 content = ev.get("content", {})
                 if isinstance(content, dict) and "name" in content:
                     last_action_type = content["name"]
-            elif ev["type"] == "Observation":
-                events_text += f"観察: {str(ev.get('content', ''))}\n"
-            elif ev["type"] == "Summary":
-                events_text += f"要約: {ev['content']}\n"
-        
+
         # 会話フローのガイダンスを追加
         if user_responses_count > 1 and last_action_type == "message_notify_user" and \
            len(self._recent_notifications) >= 2:
-            events_text += "\n<会話フローガイダンス>\n"
-            events_text += "ユーザーはすでに質問に回答しており、通知で確認済みです。\n"
-            events_text += "次のステップに進み、同じ内容の通知を繰り返さず、message_ask_user で次の質問を行ってください。\n"
-            events_text += "</会話フローガイダンス>\n"
-        
+            parts.append(_FLOW_GUIDANCE)
+
         # 最後のメッセージがユーザーからで、直後にアクションがまだない場合
-        if last_user_message and self.context.get_events()[-1]["type"] == "Message":
-            events_text += "\n<会話状態>\n"
-            events_text += "ユーザーが質問に回答したところです。この回答を確認した後、message_ask_user で次の質問に進んでください。\n"
-            events_text += "</会話状態>\n"
-        
-        memory_state = self.memory.get_relevant_state()
-        tools = ", ".join(self.tool_registry.get_tool_names())
-        
-        return (
-            f"{self.system_prompt}\n\n"
-            f"==== イベントストリーム ====\n{events_text}\n\n"
-            f"==== メモリ状態 ====\n{memory_state}\n\n"
-            f"利用可能なツール: {tools}\n"
-            "次のアクションとして必ず 1 つだけツールを JSON 形式で呼び出してください。\n"
-            "フォーマット:\n```json\n{\"name\": <tool_name>, \"parameters\": {...}}\n```\n"
-            "\n<会話ガイドライン>\n"
-            "* ユーザーの回答を受け取った後は、回答の確認は一度だけにしてください\n"
-            "* 同じような通知メッセージを繰り返し送らないでください\n"
-            "* 次のステップに関する質問は message_ask_user で行ってください\n"
-            "</会話ガイドライン>\n"
-        )
+        if last_user_message and events[-1]["type"] == "Message":
+            parts.append(_ANSWERED_STATE)
+
+        parts.append(_PROMPT_MEMORY_HEADER)
+        with self._memory_lock:
+            parts.append(self.memory.get_relevant_state())
+        return _PROMPT_EVENTS_HEADER + "".join(parts)
+
+    def _get_system_message(self) -> str:
+        # ツール一覧の文字列はレジストリ側でキャッシュされ、登録時のみ作り直される
+        tools = self.tool_registry.get_tool_names_text()
+        if tools is not self._prompt_tools:
+            self._system_message = self.system_prompt + _PROMPT_SUFFIX_TEMPLATE.format(tools=tools)
+            self._prompt_tools = tools
+            self._system_hash = hashlib.blake2b(self._system_message.encode("utf-8") + b"\0", digest_size=16)
+        return self._system_message
+
+    def _messages(self, prompt: str) -> List[Dict[str, str]]:
+        # 静的な system メッセージを先頭に、動的なイベント・メモリを user メッセージに置く
+        return [
+            {"role": "system", "content": self._get_system_message()},
+            {"role": "user", "content": prompt},
+        ]
+
+    def _get_llm_response(self, prompt: str) -> Any:
+        cache = self._response_cache
+        if cache is None:
+            return self._request_llm_response(prompt)
+        self._get_system_message()
+        # system メッセージ部分はハッシュ途中状態を複製して再計算しない
+        h = self._system_hash.copy()
+        h.update(prompt.encode("utf-8"))
+        key = h.digest()
+        cached = cache.get(key)
+        if cached is not None:
+            cache.move_to_end(key)
+            logger.debug("LLM 応答キャッシュにヒットしました")
+            # 呼び出し側がパース結果を書き換えてもキャッシュが汚れないよう複製して返す
+            return copy.deepcopy(cached)
+        content = self._request_llm_response(prompt)
+        cache[key] = copy.deepcopy(content)
+        if len(cache) > _RESPONSE_CACHE_SIZE:
+            cache.popitem(last=False)
+        return content
 
-    def _get_llm_response(self, prompt: str) -> str:
+    def _request_llm_response(self, prompt: str) -> Any:
+        # ストリーミング対応クライアントならツール呼び出し JSON が閉じた時点で受信を打ち切る
+        stream = getattr(self.llm_client, "stream_chat_completion", None)
+        if stream is not None:
+            content, _ = stream(
+                messages=self._messages(prompt),
+                temperature=self._llm_temperature,
+                max_tokens=self._llm_max_tokens,
+            )
+            return content
         content, _ = self.llm_client.chat_completion(
-            messages=[{"role": "system", "content": self.system_prompt}, {"role": "user", "content": prompt}],
-            temperature=CONFIG["llm"]["temperature"],
-            max_tokens=CONFIG["llm"]["max_tokens"],
+            messages=self._messages(prompt),
+            temperature=self._llm_temperature,
+            max_tokens=self._llm_max_tokens,
             force_json=False,
         )
         return content
 
-    def _extract_tool_call(self, text: Dict) -> Optional[Dict[str, Any]]:
-        try:
-            data = text
-            return data if "name" in data else None
-        except Exception:
+    def _extract_tool_calls(self, data: Any) -> Optional[List[Dict[str, Any]]]:
+        """
+        LLM 応答からツール呼び出しのリストを取り出す。
+        JSON の抽出・パースは LLM クライアント側で済んでいるため形だけ確認する。
+        単一呼び出し {"name": ..., "parameters": ...} と複数呼び出し {"calls": [...]} の両方に対応。
+        """
+        if not isinstance(data, dict):
             return None
+        if "name" in data:
+            return [data]
+        calls = data.get("calls")
+        if isinstance(calls, list):
+            valid = [c for c in calls if isinstance(c, dict) and "name" in c]
+            return valid or None
+        return None
 
     # プロパティ
     @property
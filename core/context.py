@@ -3,21 +3,39 @@
 エージェントのイベントストリームとコンテキスト管理。
 """
 from core.logging_config import logger
-from typing import List, Dict, Any, Optional
+from typing import Callable, List, Dict, Any, Optional
 from collections import deque
 
 
 
 class Context:
-    def __init__(self, max_events: int = 50):
-        self.events = deque(maxlen=max_events)
+    def __init__(self, max_events: int = 50, evict_batch: Optional[int] = None,
+                 renderer: Optional[Callable[[Dict[str, Any]], str]] = None):
+        self.events = deque()
         self.max_events = max_events
+        # 追加時にイベントのプロンプト用文字列を一度だけ生成して "_rendered" に保持する
+        self.renderer = renderer
+        # 描画済み文字列をイベントと同じ順序で保持し、連結結果は次の変更まで使い回す
+        self._texts = deque()
+        self._text_cache: Optional[str] = None
+        # 上限超過時は古いイベントを1件ずつではなくまとめて捨てる。
+        # 毎回先頭がずれるとプロンプトの先頭一致キャッシュが効かなくなるため。
+        self.evict_batch = evict_batch if evict_batch is not None else max(1, max_events // 4)
     
     def add_event(self, event: Dict[str, Any]) -> None:
         if 'type' not in event:
             logger.warning("eventに'type'がありません")
             return
+        if self.renderer is not None and "_rendered" not in event:
+            event["_rendered"] = self.renderer(event)
         self.events.append(event)
+        self._texts.append(event.get("_rendered", ""))
+        self._text_cache = None
+        if len(self.events) > self.max_events:
+            drop = min(len(self.events) - self.max_events + self.evict_batch - 1, len(self.events) - 1)
+            for _ in range(drop):
+                self.events.popleft()
+                self._texts.popleft()
     
     def get_events(self, limit: Optional[int] = None) -> List[Dict[str, Any]]:
         if limit is None or limit >= len(self.events):
@@ -25,5 +43,13 @@ class Context:
         else:
             return list(self.events)[-limit:]
     
+    def get_text(self) -> str:
+        """全イベントの描画済み文字列を連結して返す（renderer 未指定時は空文字列）。"""
+        if self._text_cache is None:
+            self._text_cache = "".join(self._texts)
+        return self._text_cache
+
     def clear(self):
         self.events.clear()
+        self._texts.clear()
+        self._text_cache = None
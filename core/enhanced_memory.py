@@ -8,7 +8,9 @@
 """
 import os
 from core.logging_config import logger
+import atexit
 import json
+import threading
 import time
 import re
 import random
@@ -19,6 +21,51 @@ import pickle
 from core.memory import Memory
 
 
+# 観察由来のドキュメントはこの件数たまるか、この秒数経ったらまとめてベクトル化する
+_VECTOR_BATCH_SIZE = 16
+_VECTOR_FLUSH_INTERVAL = 2.0
+
+# 追加待ちのドキュメントを持つインスタンス。プロセス共通の1本のスレッドがまとめて処理し、
+# 処理した時点で集合から外すため、セッション終了後のインスタンスを保持し続けることはない
+_VECTOR_QUEUED: Set["EnhancedMemory"] = set()
+_VECTOR_COND = threading.Condition()
+_vector_urgent = False
+_vector_worker: Optional[threading.Thread] = None
+
+
+def _flush_queued_vectors() -> None:
+    """追加待ちのあるすべてのインスタンスのキューをベクトルメモリに反映する。"""
+    global _vector_urgent
+    with _VECTOR_COND:
+        memories = list(_VECTOR_QUEUED)
+        _VECTOR_QUEUED.clear()
+        _vector_urgent = False
+    for memory in memories:
+        memory.flush_vector_queue()
+
+
+def _vector_flush_loop() -> None:
+    while True:
+        with _VECTOR_COND:
+            if not _vector_urgent:
+                _VECTOR_COND.wait(timeout=_VECTOR_FLUSH_INTERVAL)
+        _flush_queued_vectors()
+
+
+def _schedule_vector_flush(memory: "EnhancedMemory", urgent: bool) -> None:
+    global _vector_urgent, _vector_worker
+    with _VECTOR_COND:
+        _VECTOR_QUEUED.add(memory)
+        if _vector_worker is None:
+            _vector_worker = threading.Thread(target=_vector_flush_loop, name="vector-memory", daemon=True)
+            _vector_worker.start()
+        if urgent:
+            _vector_urgent = True
+            _VECTOR_COND.notify()
+
+
+atexit.register(_flush_queued_vectors)
+
 
 class EnhancedMemory(Memory):
     """
@@ -59,6 +106,11 @@ class EnhancedMemory(Memory):
             logger.warning("基本的なメモリのみを使用します")
             self._vector_memory_available = False
         
+        # ベクトルメモリへの追加待ちキュー（処理はモジュール共通のスレッドが行う）
+        self._vector_pending: List[Tuple[str, str, Dict[str, Any]]] = []
+        self._vector_pending_lock = threading.Lock()
+        self._vector_lock = threading.Lock()  # FAISS インデックスの追加と検索を排他
+        
         # ワークスペースにメモリディレクトリを作成
         self.memory_dir = os.path.join(workspace_dir, ".memory")
         os.makedirs(self.memory_dir, exist_ok=True)
@@ -125,158 +177,194 @@ class EnhancedMemory(Memory):
         tool_name = tool_call.get("name", "")
         params = tool_call.get("parameters", {})
         
-        # コード履歴の記録 (CodeActパラダイム)
-        if tool_name == "code_execute":
-            code = params.get("code", "")
-            description = params.get("description", "未指定")
+        # 対象ツールのハンドラだけを呼ぶ（大半のツールは該当なしで素通り）
+        handler = self._OBSERVATION_HANDLERS.get(tool_name)
+        if handler is not None:
+            handler(self, tool_name, params, result)
+        
+        # 定期的にメモリを永続化
+        if random.random() < 0.1:  # 約10%の確率で保存（頻度を下げる）
+            self._save_persistent_memory()
+    
+    def _observe_code_execution(self, tool_name: str, params: Dict[str, Any], result: Any) -> None:
+        """コード履歴の記録 (CodeActパラダイム)"""
+        code = params.get("code", "")
+        description = params.get("description", "未指定")
+        
+        if code:
+            # コード履歴に追加
+            self.code_history.append({
+                "timestamp": time.time(),
+                "code": code,
+                "description": description,
+                "result_snippet": str(result)[:200] + ("..." if len(str(result)) > 200 else ""),
+            })
             
-            if code:
-                # コード履歴に追加
-                self.code_history.append({
-                    "timestamp": time.time(),
-                    "code": code,
-                    "description": description,
-                    "result_snippet": str(result)[:200] + ("..." if len(str(result)) > 200 else ""),
-                })
-                
-                # 実行結果も記録
-                self.execution_results.append({
-                    "timestamp": time.time(),
-                    "tool": tool_name,
-                    "code_snippet": code[:50] + ("..." if len(code) > 50 else ""),
-                    "result": result,
-                })
-                
-                # ベクトルメモリに追加
-                if self._vector_memory_available:
-                    self.vector_memory.add_document(
-                        text=f"コード: {code}\n\n実行結果: {result}",
-                        source=f"code_execution:{time.time()}",
-                        metadata={
-                            "type": "code_execution",
-                            "description": description,
-                            "timestamp": time.time()
-                        }
-                    )
-        
-        # データ分析の記録
-        elif tool_name == "codeact_data_analysis":
-            code = params.get("code", "")
-            data_file = params.get("data_file", "")
+            # 実行結果も記録
+            self.execution_results.append({
+                "timestamp": time.time(),
+                "tool": tool_name,
+                "code_snippet": code[:50] + ("..." if len(code) > 50 else ""),
+                "result": result,
+            })
             
-            if code and data_file:
-                # 分析履歴に追加
-                self.execution_results.append({
-                    "timestamp": time.time(),
-                    "tool": tool_name,
-                    "data_file": data_file,
-                    "code_snippet": code[:50] + ("..." if len(code) > 50 else ""),
-                    "result_snippet": str(result)[:200] + ("..." if len(str(result)) > 200 else ""),
-                })
-                
-                # ベクトルメモリに追加
-                if self._vector_memory_available:
-                    self.vector_memory.add_document(
-                        text=f"データファイル: {data_file}\nコード: {code}\n\n分析結果: {result}",
-                        source=f"data_analysis:{os.path.basename(data_file)}",
-                        metadata={
-                            "type": "data_analysis",
-                            "data_file": data_file,
-                            "timestamp": time.time()
-                        }
-                    )
-        
-        # ファイル操作から知識を獲得
-        elif tool_name == "file_write":
-            file_path = params.get("file", "")
-            content = params.get("content", "")
+            # ベクトルメモリに追加
+            if self._vector_memory_available:
+                self._enqueue_vector_document(
+                    text=f"コード: {code}\n\n実行結果: {result}",
+                    source=f"code_execution:{time.time()}",
+                    metadata={
+                        "type": "code_execution",
+                        "description": description,
+                        "timestamp": time.time()
+                    }
+                )
+    
+    def _observe_data_analysis(self, tool_name: str, params: Dict[str, Any], result: Any) -> None:
+        """データ分析の記録"""
+        code = params.get("code", "")
+        data_file = params.get("data_file", "")
+        
+        if code and data_file:
+            # 分析履歴に追加
+            self.execution_results.append({
+                "timestamp": time.time(),
+                "tool": tool_name,
+                "data_file": data_file,
+                "code_snippet": code[:50] + ("..." if len(code) > 50 else ""),
+                "result_snippet": str(result)[:200] + ("..." if len(str(result)) > 200 else ""),
+            })
             
-            if file_path and content and len(content) > 10:
-                # コンテキストファイルの場合は特別扱い
-                context_files = ["todo.md", "notes.md", "plan.md", "report.md", "summary.md"]
-                if any(os.path.basename(file_path).lower() == cf for cf in context_files):
-                    self.variables["last_updated_context_file"] = file_path
-                    self.variables["last_context_update_time"] = time.time()
-                
-                # ベクトルメモリに追加
-                if self._vector_memory_available:
-                    self.vector_memory.add_document(
-                        text=content,
-                        source=f"file:{os.path.basename(file_path)}",
-                        metadata={
-                            "file_path": file_path,
-                            "operation": "write",
-                            "timestamp": time.time()
-                        }
-                    )
-        
-        # ブラウザや検索結果から知識を獲得
-        elif tool_name in ["browser_navigate", "browser_extract_elements", "browser_extract_structured_data"]:
-            url = params.get("url", "")
+            # ベクトルメモリに追加
+            if self._vector_memory_available:
+                self._enqueue_vector_document(
+                    text=f"データファイル: {data_file}\nコード: {code}\n\n分析結果: {result}",
+                    source=f"data_analysis:{os.path.basename(data_file)}",
+                    metadata={
+                        "type": "data_analysis",
+                        "data_file": data_file,
+                        "timestamp": time.time()
+                    }
+                )
+    
+    def _observe_file_write(self, tool_name: str, params: Dict[str, Any], result: Any) -> None:
+        """ファイル操作から知識を獲得"""
+        file_path = params.get("file", "")
+        content = params.get("content", "")
+        
+        if file_path and content and len(content) > 10:
+            # コンテキストファイルの場合は特別扱い
+            context_files = ["todo.md", "notes.md", "plan.md", "report.md", "summary.md"]
+            if any(os.path.basename(file_path).lower() == cf for cf in context_files):
+                self.variables["last_updated_context_file"] = file_path
+                self.variables["last_context_update_time"] = time.time()
             
-            # URLがなくても現在のページを処理
-            if isinstance(result, str) and len(result) > 100:
-                source = f"web:{url}" if url else "web:current_page"
-                
-                # ブラウジング履歴に追加
-                self.browsing_history.append({
-                    "timestamp": time.time(),
-                    "url": url or "current_page",
-                    "action": tool_name,
-                    "result_snippet": result[:200] + ("..." if len(result) > 200 else ""),
-                })
-                
-                # ベクトルメモリに追加
-                if self._vector_memory_available:
-                    self.vector_memory.add_document(
-                        text=result,
-                        source=source,
-                        metadata={
-                            "url": url or "current_page",
-                            "operation": tool_name,
-                            "timestamp": time.time()
-                        }
-                    )
-        
-        elif tool_name == "info_search_web" and isinstance(result, str) and len(result) > 100:
-            query = params.get("query", "")
+            # ベクトルメモリに追加
+            if self._vector_memory_available:
+                self._enqueue_vector_document(
+                    text=content,
+                    source=f"file:{os.path.basename(file_path)}",
+                    metadata={
+                        "file_path": file_path,
+                        "operation": "write",
+                        "timestamp": time.time()
+                    }
+                )
+    
+    def _observe_browsing(self, tool_name: str, params: Dict[str, Any], result: Any) -> None:
+        """ブラウザの閲覧結果から知識を獲得"""
+        url = params.get("url", "")
+        
+        # URLがなくても現在のページを処理
+        if isinstance(result, str) and len(result) > 100:
+            source = f"web:{url}" if url else "web:current_page"
             
-            if query:
-                # 検索履歴に追加
-                self.knowledge_entries.append({
-                    "timestamp": time.time(),
-                    "query": query,
-                    "result_snippet": result[:200] + ("..." if len(result) > 200 else ""),
-                })
-                
-                # ベクトルメモリに追加
-                if self._vector_memory_available:
-                    self.vector_memory.add_document(
-                        text=f"検索クエリ: {query}\n\n検索結果: {result}",
-                        source=f"search:{query}",
-                        metadata={
-                            "query": query,
-                            "operation": "search",
-                            "timestamp": time.time()
-                        }
-                    )
-        
-        # ユーザーとのやり取りを記録
-        elif tool_name in ["message_notify_user", "message_ask_user"]:
-            message_text = params.get("text", "")
+            # ブラウジング履歴に追加
+            self.browsing_history.append({
+                "timestamp": time.time(),
+                "url": url or "current_page",
+                "action": tool_name,
+                "result_snippet": result[:200] + ("..." if len(result) > 200 else ""),
+            })
             
-            if message_text:
-                message_type = "通知" if tool_name == "message_notify_user" else "質問"
-                self.interaction_history.append({
-                    "timestamp": time.time(),
-                    "type": message_type,
-                    "message": message_text,
-                    "response": result if tool_name == "message_ask_user" else None
-                })
-        
-        # 定期的にメモリを永続化
-        if random.random() < 0.1:  # 約10%の確率で保存（頻度を下げる）
-            self._save_persistent_memory()
+            # ベクトルメモリに追加
+            if self._vector_memory_available:
+                self._enqueue_vector_document(
+                    text=result,
+                    source=source,
+                    metadata={
+                        "url": url or "current_page",
+                        "operation": tool_name,
+                        "timestamp": time.time()
+                    }
+                )
+    
+    def _observe_web_search(self, tool_name: str, params: Dict[str, Any], result: Any) -> None:
+        """Web 検索結果から知識を獲得"""
+        if not (isinstance(result, str) and len(result) > 100):
+            return
+        
+        query = params.get("query", "")
+        
+        if query:
+            # 検索履歴に追加
+            self.knowledge_entries.append({
+                "timestamp": time.time(),
+                "query": query,
+                "result_snippet": result[:200] + ("..." if len(result) > 200 else ""),
+            })
+            
+            # ベクトルメモリに追加
+            if self._vector_memory_available:
+                self._enqueue_vector_document(
+                    text=f"検索クエリ: {query}\n\n検索結果: {result}",
+                    source=f"search:{query}",
+                    metadata={
+                        "query": query,
+                        "operation": "search",
+                        "timestamp": time.time()
+                    }
+                )
+    
+    def _observe_user_interaction(self, tool_name: str, params: Dict[str, Any], result: Any) -> None:
+        """ユーザーとのやり取りを記録"""
+        message_text = params.get("text", "")
+        
+        if message_text:
+            message_type = "通知" if tool_name == "message_notify_user" else "質問"
+            self.interaction_history.append({
+                "timestamp": time.time(),
+                "type": message_type,
+                "message": message_text,
+                "response": result if tool_name == "message_ask_user" else None
+            })
+    
+    _OBSERVATION_HANDLERS = {
+        "code_execute": _observe_code_execution,
+        "codeact_data_analysis": _observe_data_analysis,
+        "file_write": _observe_file_write,
+        "browser_navigate": _observe_browsing,
+        "browser_extract_elements": _observe_browsing,
+        "browser_extract_structured_data": _observe_browsing,
+        "info_search_web": _observe_web_search,
+        "message_notify_user": _observe_user_interaction,
+        "message_ask_user": _observe_user_interaction,
+    }
+    
+    def _enqueue_vector_document(self, text: str, source: str, metadata: Dict[str, Any]) -> None:
+        """ベクトルメモリへの追加をキューに積む（埋め込みはバックグラウンドでまとめて行う）。"""
+        with self._vector_pending_lock:
+            self._vector_pending.append((text, source, metadata))
+            urgent = len(self._vector_pending) >= _VECTOR_BATCH_SIZE
+        _schedule_vector_flush(self, urgent)
+    
+    def flush_vector_queue(self) -> None:
+        """キューにたまったドキュメントをまとめてベクトルメモリに追加します。"""
+        with self._vector_pending_lock:
+            batch, self._vector_pending = self._vector_pending, []
+        if batch:
+            with self._vector_lock:
+                self.vector_memory.add_documents_batch(batch)
     
     def get_relevant_state(self) -> str:
         """
@@ -483,8 +571,12 @@ class EnhancedMemory(Memory):
         # クエリを拡張
         expanded_query = self._expand_query(query)
         
+        # 未反映のドキュメントも検索対象に含める
+        self.flush_vector_queue()
+        
         # 関連コンテキストを取得
-        results = self.vector_memory.search(expanded_query, limit)
+        with self._vector_lock:
+            results = self.vector_memory.search(expanded_query, limit)
         
         # 結果の再ランク付け
         reranked_results = self._rerank_results(results, query)
@@ -564,7 +656,8 @@ class EnhancedMemory(Memory):
         })
         
         if self._vector_memory_available:
-            self.vector_memory.add_conversation(user_message, agent_response)
+            with self._vector_lock:
+                self.vector_memory.add_conversation(user_message, agent_response)
             
         # メモリを永続化
         self._save_persistent_memory()
@@ -588,15 +681,16 @@ class EnhancedMemory(Memory):
         
         # ベクトルメモリにも追加
         if self._vector_memory_available:
-            self.vector_memory.add_document(
-                text=f"トピック: {topic}\n\n{content}",
-                source=f"knowledge:{source}",
-                metadata={
-                    "topic": topic,
-                    "source": source,
-                    "timestamp": time.time()
-                }
-            )
+            with self._vector_lock:
+                self.vector_memory.add_document(
+                    text=f"トピック: {topic}\n\n{content}",
+                    source=f"knowledge:{source}",
+                    metadata={
+                        "topic": topic,
+                        "source": source,
+                        "timestamp": time.time()
+                    }
+                )
             
         # メモリを永続化
         self._save_persistent_memory()
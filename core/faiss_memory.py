@@ -2,23 +2,73 @@
 """
 FAISSを使用したベクトルメモリ実装。
 ChromaDBの代替としてより簡単にインストールできるFAISSを使用。
+
+埋め込みは L2 正規化して IndexFlatIP に格納する（内積 = コサイン類似度、値が大きいほど関連が強い）。
+PyPI の faiss-cpu (>=1.7) は AVX2 対応でビルドされており、内積検索に SIMD カーネルが使われる。
 """
 import os
 from core.logging_config import logger
+import atexit
 import time
-import json
+import weakref
 import pickle
 import numpy as np
 from typing import Dict, List, Any, Optional, Tuple
 
 from sentence_transformers import SentenceTransformer
 
+from config import CONFIG
+from core.json_utils import dumps_bytes, loads as _loads
+
 try:
     import faiss
 except ImportError:
-    logging.error("FAISSがインストールされていません。'uv add faiss-cpu' を実行してください。")
+    logger.error("FAISSがインストールされていません。'uv add faiss-cpu' を実行してください。")
     raise
 
+# この件数の追加ごとにインデックスファイルを書き出す（メタデータは追加のたびに追記）
+_INDEX_SAVE_INTERVAL = 100
+
+# 終了時にインデックスを書き出すインスタンス（弱参照なのでセッション終了後は解放される。
+# 書き出せなかった分は次回読み込み時に JSONL のメタデータから再構築される）
+_OPEN_MEMORIES: "weakref.WeakSet[FAISSMemory]" = weakref.WeakSet()
+
+
+def _save_all_on_exit() -> None:
+    for memory in list(_OPEN_MEMORIES):
+        memory._save_on_exit()
+
+
+atexit.register(_save_all_on_exit)
+
+
+def _dump_line(obj: Dict[str, Any]) -> bytes:
+    """メタデータ1件を JSONL の1行にシリアライズ"""
+    return dumps_bytes(obj) + b"\n"
+
+
+def _load_metadata_lines(path: str) -> Tuple[List[str], List[Dict[str, Any]], bool]:
+    """
+    JSONL のメタデータファイルを読み込む
+    
+    Returns:
+        (ドキュメント, メタデータ, 末尾まで正常に読めたか) のタプル
+    """
+    documents, metadata = [], []
+    with open(path, 'rb') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                if not line.endswith(b"\n"):
+                    raise ValueError("改行で終わっていない行")
+                entry = _loads(line)
+            except ValueError:
+                logger.warning("書き込み途中のメタデータ行を読み飛ばしました")
+                return documents, metadata, False
+            documents.append(entry.get('document', ''))
+            metadata.append(entry.get('metadata', {}))
+    return documents, metadata, True
 
 
 class FAISSMemory:
@@ -39,37 +89,61 @@ class FAISSMemory:
         os.makedirs(self.db_dir, exist_ok=True)
         
         self.index_path = os.path.join(self.db_dir, "faiss_index.bin")
-        self.metadata_path = os.path.join(self.db_dir, "faiss_metadata.json")
+        # メタデータは追記専用の JSONL（旧形式の JSON は初回読み込み時に移行する）
+        self.metadata_path = os.path.join(self.db_dir, "faiss_metadata.jsonl")
+        self.legacy_metadata_path = os.path.join(self.db_dir, "faiss_metadata.json")
         
         # 埋め込みモデルの初期化
         self.model = SentenceTransformer(embedding_model)
         self.embedding_dim = self.model.get_sentence_embedding_dimension()
         
+        # バッチ追加・検索で使う OpenMP スレッド数（0 なら FAISS の既定値）
+        num_threads = CONFIG["vector_memory"].get("num_threads", 0)
+        if num_threads > 0:
+            faiss.omp_set_num_threads(num_threads)
+        
         # インデックスと関連データの初期化/読み込み
         self.index = None
         self.documents = []  # テキストドキュメント
         self.metadata = []   # 各ドキュメントに関連するメタデータ
+        self._index_dirty = False  # インデックスファイルに未保存のベクトルがあるか
         self.load_or_create_index()
+        _OPEN_MEMORIES.add(self)
         
         logger.info(f"FAISSメモリシステムが初期化されました (埋め込み次元: {self.embedding_dim})")
     
     def load_or_create_index(self):
         """既存のインデックスを読み込むか、新しいインデックスを作成"""
         try:
-            if os.path.exists(self.index_path) and os.path.exists(self.metadata_path):
-                # インデックスの読み込み
-                self.index = faiss.read_index(self.index_path)
+            has_metadata = os.path.exists(self.metadata_path) or os.path.exists(self.legacy_metadata_path)
+            if has_metadata:
+                # インデックスの読み込み（ファイルが無ければメタデータから作り直す）
+                if os.path.exists(self.index_path):
+                    self.index = faiss.read_index(self.index_path)
+                    if self.index.metric_type != faiss.METRIC_INNER_PRODUCT:
+                        self.index = self._convert_to_inner_product(self.index)
+                else:
+                    self.index = faiss.IndexFlatIP(self.embedding_dim)
                 
                 # メタデータの読み込み
-                with open(self.metadata_path, 'r', encoding='utf-8') as f:
-                    metadata_dict = json.load(f)
+                if os.path.exists(self.metadata_path):
+                    self.documents, self.metadata, clean = _load_metadata_lines(self.metadata_path)
+                    if not clean:
+                        # 壊れた末尾行の後ろに追記し続けないよう、読めた分で書き直す
+                        self._rewrite_metadata()
+                else:
+                    with open(self.legacy_metadata_path, 'rb') as f:
+                        metadata_dict = _loads(f.read())
                     self.documents = metadata_dict.get('documents', [])
                     self.metadata = metadata_dict.get('metadata', [])
+                    self._rewrite_metadata()
+                    logger.info("FAISSメタデータを JSONL 形式に移行しました")
                 
+                self._reconcile_index()
                 logger.info(f"既存のFAISSインデックスを読み込みました (ドキュメント数: {len(self.documents)})")
             else:
                 # 新しいインデックスの作成
-                self.index = faiss.IndexFlatL2(self.embedding_dim)
+                self.index = faiss.IndexFlatIP(self.embedding_dim)
                 self.documents = []
                 self.metadata = []
                 self.save_index()
@@ -77,24 +151,78 @@ class FAISSMemory:
         except Exception as e:
             logger.error(f"インデックス読み込み/作成中にエラー: {str(e)}")
             # フォールバック: 新しいインデックスを作成
-            self.index = faiss.IndexFlatL2(self.embedding_dim)
+            self.index = faiss.IndexFlatIP(self.embedding_dim)
             self.documents = []
             self.metadata = []
     
+    def _reconcile_index(self):
+        """インデックスファイルとメタデータの件数のずれを、前回保存以降の差分だけで解消する"""
+        indexed = self.index.ntotal
+        if indexed < len(self.documents):
+            # 前回終了までにインデックスへ書き出されなかった分だけ埋め込み直す
+            self.index.add(self._embed(self.documents[indexed:]))
+            self._write_index()
+            logger.info(f"未保存だったベクトルを再構築しました ({len(self.documents) - indexed}件)")
+        elif indexed > len(self.documents):
+            # メタデータの無いベクトル（書き込み途中で終了した行の分）を取り除く
+            vectors = self.index.reconstruct_n(0, len(self.documents)) if self.documents else None
+            self.index = faiss.IndexFlatIP(self.embedding_dim)
+            if vectors is not None:
+                self.index.add(vectors)
+            self._write_index()
+    
+    def _convert_to_inner_product(self, old_index):
+        """旧形式（IndexFlatL2）のインデックスをベクトルを正規化した IndexFlatIP に移し替える"""
+        index = faiss.IndexFlatIP(self.embedding_dim)
+        if old_index.ntotal:
+            vectors = np.ascontiguousarray(old_index.reconstruct_n(0, old_index.ntotal), dtype='float32')
+            faiss.normalize_L2(vectors)
+            index.add(vectors)
+        logger.info("FAISSインデックスを内積（コサイン類似度）形式に変換しました")
+        return index
+    
+    def _embed(self, texts: List[str]) -> np.ndarray:
+        """テキストを埋め込み、内積検索用に L2 正規化した float32 配列を返す"""
+        embeddings = self.model.encode(texts, batch_size=32)
+        embedding_np = np.ascontiguousarray(embeddings, dtype='float32')
+        faiss.normalize_L2(embedding_np)
+        return embedding_np
+    
+    def _write_index(self):
+        """インデックスのみをディスクに書き出す"""
+        faiss.write_index(self.index, self.index_path)
+        self._index_dirty = False
+    
+    def _append_metadata(self, documents: List[str], metadatas: List[Dict[str, Any]]):
+        """追加分のメタデータを JSONL に追記（既存の内容は書き換えない）"""
+        with open(self.metadata_path, 'ab') as f:
+            f.write(b"".join(
+                _dump_line({'document': doc, 'metadata': meta})
+                for doc, meta in zip(documents, metadatas)
+            ))
+    
+    def _rewrite_metadata(self):
+        """全メタデータを JSONL として書き直す"""
+        tmp_path = self.metadata_path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(b"".join(
+                _dump_line({'document': doc, 'metadata': meta})
+                for doc, meta in zip(self.documents, self.metadata)
+            ))
+        os.replace(tmp_path, self.metadata_path)
+    
+    def _save_on_exit(self):
+        if self._index_dirty:
+            try:
+                self._write_index()
+            except Exception as e:
+                logger.error(f"終了時のインデックス保存中にエラー: {str(e)}")
+    
     def save_index(self):
         """インデックスとメタデータをディスクに保存"""
         try:
-            # インデックスの保存
-            faiss.write_index(self.index, self.index_path)
-            
-            # メタデータの保存
-            metadata_dict = {
-                'documents': self.documents,
-                'metadata': self.metadata
-            }
-            with open(self.metadata_path, 'w', encoding='utf-8') as f:
-                json.dump(metadata_dict, f, ensure_ascii=False, indent=2)
-            
+            self._write_index()
+            self._rewrite_metadata()
             logger.info(f"FAISSインデックスを保存しました (ドキュメント数: {len(self.documents)})")
         except Exception as e:
             logger.error(f"インデックス保存中にエラー: {str(e)}")
@@ -110,33 +238,54 @@ class FAISSMemory:
         """
         if not text or len(text.strip()) < 10:
             return
+        return self.add_documents_batch([(text, source, metadata)]) > 0
+    
+    def add_documents_batch(self, items: List[Tuple[str, str, Optional[Dict[str, Any]]]]) -> int:
+        """
+        複数のドキュメントをまとめてインデックスに追加（埋め込みと index.add を1回ずつで済ませる）
+        
+        Args:
+            items: (テキスト, 情報源の識別子, メタデータ) のリスト
+            
+        Returns:
+            追加したドキュメント数
+        """
+        items = [item for item in items if item[0] and len(item[0].strip()) >= 10]
+        if not items:
+            return 0
         
         try:
-            # メタデータの準備
-            doc_metadata = metadata or {}
-            doc_metadata.update({
-                'source': source,
-                'timestamp': time.time()
-            })
+            texts = [text for text, _, _ in items]
+            now = time.time()
+            metadatas = []
+            for _, source, metadata in items:
+                doc_metadata = metadata or {}
+                doc_metadata.update({
+                    'source': source,
+                    'timestamp': now
+                })
+                metadatas.append(doc_metadata)
             
-            # テキストの埋め込み
-            embedding = self.model.encode([text])[0]  # 1つのテキストの埋め込みを取得
-            embedding_np = np.array([embedding]).astype('float32')
+            # テキストの埋め込み（バッチ）
+            embedding_np = self._embed(texts)
             
-            # インデックスに追加
+            # インデックスに追加し、メタデータは追記のみ
+            before = len(self.documents)
             self.index.add(embedding_np)
-            self.documents.append(text)
-            self.metadata.append(doc_metadata)
+            self.documents.extend(texts)
+            self.metadata.extend(metadatas)
+            self._append_metadata(texts, metadatas)
+            self._index_dirty = True
             
-            # 定期的に保存
-            if len(self.documents) % 10 == 0:
-                self.save_index()
+            # インデックスファイルは一定件数ごと（と終了時）に書き出す
+            if len(self.documents) // _INDEX_SAVE_INTERVAL != before // _INDEX_SAVE_INTERVAL:
+                self._write_index()
                 
-            logger.info(f"ドキュメントをFAISSインデックスに追加しました (source: {source})")
-            return True
+            logger.info(f"ドキュメントをFAISSインデックスに追加しました ({len(texts)}件)")
+            return len(texts)
         except Exception as e:
             logger.error(f"ドキュメント追加中にエラー: {str(e)}")
-            return False
+            return 0
     
     def add_conversation(self, user_message: str, agent_response: str):
         """
@@ -174,6 +323,7 @@ class FAISSMemory:
             # クエリの埋め込み
             query_embedding = self.model.encode([query])[0]
             query_embedding_np = np.array([query_embedding]).astype('float32')
+            faiss.normalize_L2(query_embedding_np)
             
             # 検索実行
             limit = min(limit, len(self.documents))  # インデックスサイズより大きくならないように
@@ -182,7 +332,7 @@ class FAISSMemory:
             # 結果の整形
             results = []
             for i, idx in enumerate(indices[0]):
-                if idx < len(self.documents):  # 安全チェック
+                if 0 <= idx < len(self.documents):  # 安全チェック（FAISS は不足分を -1 で返す）
                     results.append((
                         self.documents[idx],
                         self.metadata[idx],
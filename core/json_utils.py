@@ -0,0 +1,43 @@
+# core/json_utils.py
+"""
+JSON シリアライズの共通ヘルパ
+============================
+orjson があれば優先し、無い環境や orjson が扱えない型では標準 json にフォールバックする。
+"""
+
+import json
+from typing import Any, Union
+
+try:
+    import orjson
+except ImportError:  # orjson が無い環境では標準 json を使用
+    orjson = None
+
+HAS_ORJSON = orjson is not None
+
+
+def dumps(obj: Any) -> str:
+    """オブジェクトを JSON 文字列にする（非 ASCII はエスケープしない）"""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj).decode()
+        except TypeError:
+            pass  # orjson が扱えない型は標準 json にフォールバック
+    return json.dumps(obj, ensure_ascii=False)
+
+
+def dumps_bytes(obj: Any) -> bytes:
+    """オブジェクトを UTF-8 の JSON バイト列にする（ファイル追記用）"""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj)
+        except TypeError:
+            pass
+    return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+
+def loads(raw: Union[str, bytes]) -> Any:
+    """JSON をパースする。失敗時はどちらの実装でも json.JSONDecodeError（ValueError）を送出する"""
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
@@ -4,8 +4,25 @@
 """
 from core.logging_config import logger
 import os
-from typing import Dict, Any
+from itertools import islice
+from typing import Dict, Any, List
 
+# file_registry に入れる状態値（文字列リテラルは1つのオブジェクトを共有する）
+_STATUS_WRITTEN = "written"
+_STATUS_STR_REPLACED = "str_replaced"
+
+# file_registry に記録するツールとそのステータス
+_FILE_TOOL_STATUS = {
+    "file_write": _STATUS_WRITTEN,
+    "file_str_replace": _STATUS_STR_REPLACED,
+}
+
+
+def _last(items, n: int) -> List[Any]:
+    """dict のキーや items() の末尾 n 件を、全体をリスト化せずに古い順で返す。"""
+    tail = list(islice(reversed(items), n))
+    tail.reverse()
+    return tail
 
 
 class Memory:
@@ -17,18 +34,9 @@ class Memory:
     
     def update_from_observation(self, tool_call: Dict[str, Any], result: Any):
         # ファイル書き込みツールやtodoへの書き込み等を追跡
-        name = tool_call.get("name", "")
-        params = tool_call.get("parameters", {})
-        
-        if name == "file_write":
-            file_path = params.get("file", "")
-            if file_path:
-                self.file_registry[file_path] = "written"
-        
-        if name == "file_str_replace":
-            file_path = params.get("file", "")
-            if file_path:
-                self.file_registry[file_path] = "str_replaced"
+        status = _FILE_TOOL_STATUS.get(tool_call.get("name", ""))
+        if status and (file_path := tool_call.get("parameters", {}).get("file", "")):
+            self.file_registry[file_path] = status
 
     def get_relevant_state(self) -> str:
         """
@@ -40,13 +48,13 @@ class Memory:
         # 最近書き込まれたファイル（最大 5 件）
         if self.file_registry:
             state_lines.append("【ファイル操作履歴】")
-            for i, path in enumerate(list(self.file_registry)[-5:], 1):
+            for i, path in enumerate(_last(self.file_registry, 5), 1):
                 state_lines.append(f"{i}. {os.path.basename(path)} -> {self.file_registry[path]}")
 
         # 任意の変数
         if self.variables:
             state_lines.append("【変数】")
-            for k, v in list(self.variables.items())[-5:]:
+            for k, v in _last(self.variables.items(), 5):
                 state_lines.append(f"{k}: {v}")
 
         return "\n".join(state_lines) if state_lines else ""
@@ -9,47 +9,170 @@ Azure OpenAI クライアント（最新版・JSON モード対応）
 """
 
 from __future__ import annotations
-import re
 import json
 from core.logging_config import logger
 import os
-from typing import Any, Dict, List, Tuple
+import threading
+from typing import Any, Dict, List, Optional, Tuple
 
+import httpx
+
+from config import validate_azure_credentials
+from core.json_utils import loads as _loads
+from llm.semantic_cache import semantic_cached
 from langchain_openai import AzureChatOpenAI
 from azure.identity import DefaultAzureCredential, get_bearer_token_provider
 
+try:  # HTTP/2 には h2 が必要。無ければ HTTP/1.1 の keep-alive のみ
+    import h2  # noqa: F401
+    _HTTP2 = True
+except ImportError:
+    _HTTP2 = False
+
+# 応答中の JSON を先頭から1パスでデコードする（正規表現のバックトラックを避ける）
+_JSON_DECODER = json.JSONDecoder()
+_FENCE_MARK = "```json"
+# JSON モード指定（呼び出しごとに作らず共有する）
+_JSON_RESPONSE_FORMAT = {"type": "json_object"}
+
+
+class _JsonObjectScanner:
+    """
+    最初の `{` から対応する `}` までを1パスで切り出すスキャナ（文字列リテラル内の括弧は無視）。
+    ストリーミング応答にも使えるよう、feed() で断片を順に受け取り状態を保持する。
+    """
+
+    def __init__(self) -> None:
+        self._buf: List[str] = []
+        self._started = False
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        # オブジェクトが閉じた後に残った同じ断片の続き
+        self.rest = ""
+
+    def feed(self, text: str) -> Optional[str]:
+        """断片を追加し、JSON オブジェクトが閉じた時点でその文字列を返す。"""
+        if not self._started:
+            start = text.find("{")
+            if start < 0:
+                return None
+            self._started = True
+            text = text[start:]
+        depth = self._depth
+        in_string = self._in_string
+        escaped = self._escaped
+        for i, c in enumerate(text):
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif c == "\\":
+                    escaped = True
+                elif c == '"':
+                    in_string = False
+            elif c == '"':
+                in_string = True
+            elif c == "{":
+                depth += 1
+            elif c == "}":
+                depth -= 1
+                if depth == 0:
+                    self._buf.append(text[:i + 1])
+                    self.rest = text[i + 1:]
+                    return "".join(self._buf)
+        self._buf.append(text)
+        self._depth = depth
+        self._in_string = in_string
+        self._escaped = escaped
+        return None
+
+
+def _extract_json(content: str) -> Any:
+    """応答テキストからツール呼び出し JSON を取り出してパースする。
+
+    ```json フェンスがあればその直後、なければ先頭から最初の `{` を探し、raw_decode で
+    オブジェクト1つ分だけをデコードする。デコードできなければ次の `{` から再試行する。
+    JSON モードなど応答全体が1つのオブジェクトの場合は、探索せずにそのままデコードする。
+    """
+    if content.lstrip()[:1] == "{":
+        try:
+            return _loads(content)
+        except ValueError:
+            pass
+    fence = content.find(_FENCE_MARK)
+    start = content.find("{", fence + len(_FENCE_MARK) if fence >= 0 else 0)
+    while start >= 0:
+        try:
+            return _JSON_DECODER.raw_decode(content, start)[0]
+        except ValueError:
+            start = content.find("{", start + 1)
+    logger.debug(f"JSON 抽出失敗: {content}")
+    raise ValueError("JSONデータが見つかりません")
+
+
+def _is_final_object(result: Any, received: str, json_text: str, rest: str) -> bool:
+    """ストリーミング中に閉じたオブジェクトで打ち切ってよいか（_extract_json と同じものを選ぶため）。
+
+    ツール呼び出しの形（"name" / "calls" を持つ dict）か、```json フェンスの後に始まったものに限る。
+    """
+    if isinstance(result, dict) and ("name" in result or "calls" in result):
+        return True
+    start = len(received) - len(rest) - len(json_text)
+    fence = received.find(_FENCE_MARK)
+    return 0 <= fence < start
+
+
+# プロセス内で共有するチャットモデル（接続プール・TLS セッション・認証トークンを使い回す）
+_shared_client: Optional[AzureChatOpenAI] = None
+_shared_client_lock = threading.Lock()
+_HTTP_LIMITS = httpx.Limits(max_connections=64, max_keepalive_connections=32)
+
+
+def _get_shared_client() -> AzureChatOpenAI:
+    """AzureChatOpenAI を初回呼び出し時に1つだけ作って返す（スレッドセーフ）。"""
+    global _shared_client
+    if _shared_client is not None:
+        return _shared_client
+    with _shared_client_lock:
+        if _shared_client is None:
+            token_provider = get_bearer_token_provider(
+                DefaultAzureCredential(), "https://cognitiveservices.azure.com/.default"
+            )
+            model_name = "gpt-4o"
+            _shared_client = AzureChatOpenAI(
+                # api_key=os.getenv("AZURE_OPENAI_API_KEY"),
+                azure_ad_token_provider=token_provider,
+                azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
+                api_version=os.getenv("AZURE_OPENAI_API_VERSION"),
+                azure_deployment=model_name,
+                max_retries=0,
+                http_client=httpx.Client(http2=_HTTP2, limits=_HTTP_LIMITS),
+                http_async_client=httpx.AsyncClient(http2=_HTTP2, limits=_HTTP_LIMITS),
+            )
+            logger.info(f"Azure OpenAI 共有クライアント初期化完了 (HTTP/2: {_HTTP2})")
+    return _shared_client
 
 
 class AzureOpenAIClient:
-    """Azure OpenAI Service ラッパー。"""
+    """Azure OpenAI Service ラッパー。下位のクライアントはプロセス内で共有する。"""
 
     def __init__(self) -> None:
-        TOKEN_PROVIDER = get_bearer_token_provider(
-            DefaultAzureCredential(), "https://cognitiveservices.azure.com/.default"
-        )
+        validate_azure_credentials()
         api_key = os.getenv("AZURE_OPENAI_API_KEY")
         endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
-        api_version = os.getenv("AZURE_OPENAI_API_VERSION")
         deployment_name = os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME")
         
-        model_name="gpt-4o"
         if not all([api_key, endpoint, deployment_name]):
             raise EnvironmentError("Azure OpenAI の環境変数が不足しています。")
         
-        self._client = AzureChatOpenAI(
-            # api_key=api_key,
-            azure_ad_token_provider=TOKEN_PROVIDER,
-            azure_endpoint=endpoint,
-            api_version=api_version,
-            azure_deployment=model_name,
-            max_retries=0
-        )
+        self._client = _get_shared_client()
         self._deployment = deployment_name
         logger.info("Azure OpenAI クライアント初期化完了")
 
     # ---------------------------------------------------------
     # チャット補完
     # ---------------------------------------------------------
+    @semantic_cached
     def chat_completion(
         self,
         messages: List[Dict[str, str]],
@@ -63,36 +186,21 @@ class AzureOpenAIClient:
             content: 生成テキスト
             usage:   {prompt_tokens, completion_tokens, total_tokens}
         """
-        params: Dict[str, Any] = {
-            # "model": self._deployment,
-            # "messages": messages,
-            "temperature": temperature,
-            "max_tokens": max_tokens,
-        }
-        if force_json:
-            params["response_format"] = {"type": "json_object"}
-
         try:
-            resp = self._client.invoke(messages,**params)
+            # 呼び出しごとに引数の辞書を組み立てず、キーワード引数で直接渡す
+            if force_json:
+                resp = self._client.invoke(
+                    messages,
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                    response_format=_JSON_RESPONSE_FORMAT,
+                )
+            else:
+                resp = self._client.invoke(messages, temperature=temperature, max_tokens=max_tokens)
             
             # content = resp.choices[0].message.content or ""
             content = resp.content
-            json_pattern = r'```json\s*(.*?)\s*```'
-            
-            match = re.search(json_pattern, content, re.DOTALL)
-        
-            if match:
-                json_text = match.group(1).strip()
-            else:
-                # JSONブロックがない場合は、{で始まり}で終わる部分を探す
-                json_pattern = r'(\{.*\})'
-                match = re.search(json_pattern, content, re.DOTALL)
-                if match:
-                    json_text = match.group(1).strip()
-                else:
-                    print(content)
-                    raise ValueError("JSONデータが見つかりません")
-            result = json.loads(json_text)
+            result = _extract_json(content)
             # Get usage from response_metadata
             usage = {}
             if hasattr(resp, 'response_metadata') and resp.response_metadata:
@@ -100,11 +208,62 @@ class AzureOpenAIClient:
                     usage = resp.response_metadata['token_usage']
                 elif 'usage_metadata' in resp.response_metadata:
                     usage = resp.response_metadata['usage_metadata']
+            # プレフィックスキャッシュのヒット状況（対応モデルのみ）
+            cached = (usage.get('prompt_tokens_details') or {}).get('cached_tokens')
+            if cached:
+                logger.debug(f"プロンプトキャッシュ: {cached}/{usage.get('prompt_tokens')} トークン")
             return result, usage
         except Exception as exc:
             logger.error(f"Azure OpenAI 呼び出し失敗: {exc}")
             raise
 
+    @semantic_cached
+    def stream_chat_completion(
+        self,
+        messages: List[Dict[str, str]],
+        temperature: float = 0.2,
+        max_tokens: int = 2048,
+    ) -> Tuple[Any, Dict[str, Any]]:
+        """ストリーミングで ChatCompletion を呼び出し、ツール呼び出し JSON が閉じた時点で打ち切る。
+
+        ツール呼び出しの後に続く説明文の生成を待たずに済む。打ち切るのは "name" か "calls" を持つ
+        オブジェクト、または ```json フェンスの後に始まったオブジェクトだけで、説明文中の例示など
+        それ以外の `{...}` は読み飛ばして次を待つ。最後まで見つからなければ chat_completion と
+        同じ方法（フェンス優先）で全文から抽出する。
+
+        Returns:
+            result: パース済みの JSON
+            usage:  早期終了時は空の辞書
+        """
+        scanner = _JsonObjectScanner()
+        parts: List[str] = []
+        stream = self._client.stream(messages, temperature=temperature, max_tokens=max_tokens)
+        try:
+            for chunk in stream:
+                text = chunk.content
+                if not text:
+                    continue
+                parts.append(text)
+                json_text = scanner.feed(text)
+                while json_text is not None:
+                    try:
+                        result = _loads(json_text)
+                    except ValueError:
+                        result = None  # 本文中の `{...}` 等で JSON でなければ読み飛ばす
+                    rest = scanner.rest
+                    if result is not None and _is_final_object(result, "".join(parts), json_text, rest):
+                        return result, {}
+                    # その直後から次のオブジェクトを待つ
+                    scanner = _JsonObjectScanner()
+                    json_text = scanner.feed(rest)
+            return _extract_json("".join(parts)), {}
+        except Exception as exc:
+            logger.error(f"Azure OpenAI ストリーミング呼び出し失敗: {exc}")
+            raise
+        finally:
+            # 早期終了時はジェネレータを閉じて HTTP ストリームを切断する
+            stream.close()
+
     def call_azure_openai(
         self,
         prompt: str,
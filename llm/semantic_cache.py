@@ -0,0 +1,143 @@
+# llm/semantic_cache.py
+"""
+チャット補完の意味的キャッシュ
+==============================
+* 直前までに送ったプロンプトと意味的にほぼ同じ呼び出しには、保存済みの応答を返す。
+* プロンプト埋め込みは L2 正規化して FAISS IndexFlatIP に格納（内積 = コサイン類似度）。
+* temperature（0.1 刻み）・force_json・system プロンプトごとに別インデックスとし、
+  JSON モードとテキストモードの応答などを取り違えないようにする。
+* 既定では無効。LLM_SEMANTIC_CACHE=true で有効化し、faiss と sentence-transformers が必要。
+"""
+
+from __future__ import annotations
+
+import copy
+import functools
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from config import CONFIG
+from core.logging_config import logger
+
+try:
+    import faiss
+    import numpy as np
+    from sentence_transformers import SentenceTransformer
+except ImportError:  # 依存が無い環境ではキャッシュを使わない
+    faiss = None
+
+
+class _Bucket:
+    """キーごとのインデックスと応答。エントリは最終利用順に並べる。"""
+
+    def __init__(self, dim: int) -> None:
+        self.index = faiss.IndexFlatIP(dim)
+        self.vectors: List[Any] = []
+        self.values: List[Any] = []
+
+    def rebuild(self) -> None:
+        self.index.reset()
+        if self.vectors:
+            self.index.add(np.stack(self.vectors))
+
+
+class SemanticCache:
+    """FAISS による意味的キャッシュ（スレッドセーフ）。"""
+
+    def __init__(self, model_name: str, threshold: float, max_entries: int) -> None:
+        self._model = SentenceTransformer(model_name)
+        self._dim = self._model.get_sentence_embedding_dimension()
+        self._threshold = threshold
+        self._max_entries = max(1, max_entries)
+        self._buckets: "OrderedDict[Tuple, _Bucket]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def embed(self, text: str) -> Any:
+        vec = self._model.encode([text], normalize_embeddings=True)[0]
+        return np.asarray(vec, dtype="float32")
+
+    def lookup(self, key: Tuple, vec: Any) -> Optional[Any]:
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None or not bucket.values:
+                return None
+            scores, ids = bucket.index.search(vec.reshape(1, -1), 1)
+            idx = int(ids[0][0])
+            if idx < 0 or float(scores[0][0]) < self._threshold:
+                return None
+            # 最近使ったエントリを末尾へ（インデックス上の位置もずれるので作り直す）
+            if idx != len(bucket.values) - 1:
+                bucket.vectors.append(bucket.vectors.pop(idx))
+                bucket.values.append(bucket.values.pop(idx))
+                bucket.rebuild()
+            return bucket.values[-1]
+
+    def add(self, key: Tuple, vec: Any, value: Any) -> None:
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = _Bucket(self._dim)
+            bucket.vectors.append(vec)
+            bucket.values.append(value)
+            if len(bucket.values) > self._max_entries:
+                # 最も長く使われていないエントリを捨てる
+                del bucket.vectors[0]
+                del bucket.values[0]
+                bucket.rebuild()
+            else:
+                bucket.index.add(vec.reshape(1, -1))
+
+
+@functools.lru_cache(maxsize=1)
+def get_semantic_cache() -> Optional[SemanticCache]:
+    """設定で有効かつ依存が揃っていればプロセス共通のキャッシュを返す。"""
+    llm_cfg = CONFIG["llm"]
+    if not llm_cfg.get("semantic_cache", False):
+        return None
+    if faiss is None:
+        logger.warning("faiss / sentence-transformers が無いため意味的キャッシュを無効にします")
+        return None
+    return SemanticCache(
+        CONFIG["vector_memory"]["embedding_model"],
+        llm_cfg.get("semantic_cache_threshold", 0.87),
+        llm_cfg.get("semantic_cache_size", 1000),
+    )
+
+
+def semantic_cached(method: Callable) -> Callable:
+    """chat_completion / stream_chat_completion 用デコレータ。
+
+    ヒット時は LLM を呼ばずに保存済みの (content, usage) を返す。force_json を取らない
+    ストリーミング版はテキストモード（force_json=False）として同じバケットを共有する。
+    どちらもパース済み JSON を返すため、互いのキャッシュ結果をそのまま使える。
+    """
+
+    @functools.wraps(method)
+    def wrapper(
+        self,
+        messages: List[Dict[str, str]],
+        temperature: float = 0.2,
+        max_tokens: int = 2048,
+        **kwargs: Any,
+    ):
+        cache = get_semantic_cache()
+        if cache is None:
+            return method(self, messages, temperature, max_tokens, **kwargs)
+
+        system = "".join(m["content"] for m in messages if m.get("role") == "system")
+        key = (round(temperature, 1), bool(kwargs.get("force_json", False)), hash(system))
+        text = "\n".join(f"{m.get('role')}: {m['content']}" for m in messages if m.get("role") != "system")
+        vec = cache.embed(text)
+
+        cached = cache.lookup(key, vec)
+        if cached is not None:
+            logger.debug("意味的キャッシュにヒットしました")
+            # 呼び出し側がパース結果を書き換えてもキャッシュが汚れないよう複製して返す
+            return copy.deepcopy(cached)
+
+        result = method(self, messages, temperature, max_tokens, **kwargs)
+        cache.add(key, vec, copy.deepcopy(result))
+        return result
+
+    return wrapper
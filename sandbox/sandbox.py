@@ -13,11 +13,15 @@ Docker サンドボックス管理モジュール（強化版・日本語コメ
 
 from __future__ import annotations
 
+import io
 import os
+import tarfile
+import threading
+import time
 import uuid
 from core.logging_config import logger
 from pathlib import Path
-from typing import Dict, Tuple
+from typing import Callable, Dict, Optional, Tuple, TypeVar
 
 import docker
 
@@ -35,14 +39,33 @@ _MEMORY_LIMIT = CONFIG["docker"].get("memory_limit", "512m")
 _CPU_LIMIT = CONFIG["docker"].get("cpu_limit", 0.5)
 _ALLOW_SUDO = CONFIG["security"].get("allow_sudo", False)
 _ALLOW_NETWORK = CONFIG["security"].get("allow_network", True)
+# stdout / stderr それぞれで保持する最大バイト数（超過分は読み捨てる）
+_MAX_OUTPUT_BYTES = 1 << 20
+_TRUNCATED_MARKER = "\n...[出力が長すぎるため切り詰めました]"
+# Docker API 接続プールの大きさ（並列ツール実行で exec ごとに接続し直さないように）
+_DOCKER_POOL_SIZE = 16
+
+_T = TypeVar("_T")
+
+
+def _append_capped(buf: bytearray, chunk: Optional[bytes]) -> bool:
+    """上限まで buf に追加し、切り捨てが発生したかを返す。"""
+    if not chunk:
+        return False
+    room = _MAX_OUTPUT_BYTES - len(buf)
+    if room > 0:
+        buf += chunk[:room]
+    return len(chunk) > room
 
 
 class DockerSandbox:
     """Docker コンテナを使った分離実行環境。"""
 
     def __init__(self) -> None:
-        self._client = docker.from_env()
+        self._client = docker.from_env(max_pool_size=_DOCKER_POOL_SIZE)
         self._containers: Dict[str, docker.models.containers.Container] = {}
+        # _containers の更新とコンテナ作成・再起動を直列化する（同名コンテナの二重作成を防ぐ）
+        self._lock = threading.RLock()
         self._ensure_image()
 
     # ------------------------------------------------------------------
@@ -62,7 +85,7 @@ class DockerSandbox:
             logger.info("ビルド完了")
 
     def _create_container(self, session_id: str) -> docker.models.containers.Container:
-        """新規コンテナを作成し、永続マッピングを設定。"""
+        """新規コンテナを作成し、永続マッピングを設定（self._lock を保持して呼ぶ）。"""
         workdir_host = _WORKSPACE_ROOT / session_id
         workdir_host.mkdir(parents=True, exist_ok=True)
 
@@ -91,53 +114,109 @@ class DockerSandbox:
         return container
 
     def _get_container(self, session_id: str):
-        if session_id in self._containers:
-            cont = self._containers[session_id]
-            cont.reload()
-            if cont.status != "running":
-                cont.start()
+        # 起動済みのハンドルは実行中とみなす（状態確認の API 呼び出しは exec 失敗時のみ）
+        cont = self._containers.get(session_id)
+        if cont is not None:
             return cont
-        return self._create_container(session_id)
+        with self._lock:
+            cont = self._containers.get(session_id)
+            if cont is not None:
+                return cont
+            return self._create_container(session_id)
+
+    def _revive_container(self, session_id: str):
+        """キャッシュしたハンドルが使えなかった場合に状態を確認し、再起動または再作成する。"""
+        with self._lock:
+            cont = self._containers.get(session_id)
+            if cont is not None:
+                try:
+                    cont.reload()
+                    if cont.status != "running":
+                        cont.start()
+                    return cont
+                except docker.errors.NotFound:
+                    # remove=True のため停止したコンテナは削除されている
+                    self._containers.pop(session_id, None)
+            return self._create_container(session_id)
+
+    def _with_container(self, session_id: str, action: Callable[..., _T]) -> _T:
+        cont = self._get_container(session_id)
+        try:
+            return action(cont)
+        except docker.errors.APIError as exc:
+            logger.warning(f"コンテナ {cont.name} での実行に失敗したため状態を確認して再試行します: {exc}")
+            return action(self._revive_container(session_id))
+
+    def _exec(self, session_id: str, cmd: str, **kwargs):
+        return self._with_container(session_id, lambda cont: cont.exec_run(cmd, **kwargs))
+
+    def _start_exec(self, session_id: str, cmd: str):
+        """exec を作成して出力ストリーム（(stdout, stderr) 断片のジェネレータ）を開始する。"""
+        api = self._client.api
+
+        def start(cont):
+            # 作成から開始までの間にコンテナが落ちても再起動後の再試行で作り直せるよう、両方をまとめて行う
+            exec_id = api.exec_create(cont.id, cmd, stdout=True, stderr=True, tty=False)["Id"]
+            return exec_id, api.exec_start(exec_id, stream=True, demux=True)
+
+        return self._with_container(session_id, start)
 
     # ------------------------------------------------------------------
     # コマンド実行 API
     # ------------------------------------------------------------------
     def execute_command(self, session_id: str, command: str, cwd: str = "/home/ubuntu/workspace") -> Tuple[str, str, int]:
-        cont = self._get_container(session_id)
-        cmd = f"bash -c 'cd {cwd} && {command}'"
-        exec_res = cont.exec_run(cmd, demux=True, stream=False, tty=False)
-        stdout, stderr = exec_res.output if exec_res.output else (b"", b"")
-        return stdout.decode(), stderr.decode(), exec_res.exit_code
+        # 出力は逐次受け取り、上限を超えた分はメモリに溜めずに捨てる
+        exec_id, chunks = self._start_exec(session_id, f"bash -c 'cd {cwd} && {command}'")
+        stdout, stderr = bytearray(), bytearray()
+        out_cut = err_cut = False
+        for out, err in chunks:
+            out_cut = _append_capped(stdout, out) or out_cut
+            err_cut = _append_capped(stderr, err) or err_cut
+        exit_code = self._client.api.exec_inspect(exec_id)["ExitCode"]
+        return (
+            stdout.decode(errors="replace") + (_TRUNCATED_MARKER if out_cut else ""),
+            stderr.decode(errors="replace") + (_TRUNCATED_MARKER if err_cut else ""),
+            exit_code,
+        )
 
     def execute_python(self, session_id: str, code: str, cwd: str = "/home/ubuntu/workspace") -> Tuple[str, str, int]:
-        cont = self._get_container(session_id)
-        tmp_name = f"/home/ubuntu/workspace/__tmp_{uuid.uuid4().hex[:8]}.py"
-        cont.exec_run(f"bash -c 'echo {json_escape(code)} > {tmp_name}'")
-        return self.execute_command(session_id, f"python3 {tmp_name}", cwd)
+        # スクリプトはメモリ上の tar として Docker ソケット経由でコンテナの /tmp に直接置く
+        # （ホスト側ワークスペースへの書き込みもシェルでのエスケープも不要）
+        name = f"__tmp_{uuid.uuid4().hex[:8]}.py"
+        data = code.encode("utf-8")
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode="w") as tar:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mode = 0o644
+            info.mtime = int(time.time())
+            tar.addfile(info, io.BytesIO(data))
+        archive = buf.getvalue()
+        self._with_container(session_id, lambda cont: cont.put_archive("/tmp", archive))
+        # 実行後は同じ exec 内で削除し、終了コードはスクリプトのものを返す
+        return self.execute_command(
+            session_id, f"python3 /tmp/{name}; status=$?; rm -f /tmp/{name}; exit $status", cwd
+        )
 
     def cleanup(self):
-        for cid, cont in list(self._containers.items()):
+        with self._lock:
+            containers = list(self._containers.values())
+            self._containers.clear()
+        for cont in containers:
             try:
                 cont.stop(timeout=2)
             except Exception:
                 pass
-        self._containers.clear()
 
 
 # シングルトンインスタンス ----------------------------------------------------
 _sandbox_instance: Optional[DockerSandbox] = None
+_sandbox_lock = threading.Lock()
 
 def get_sandbox() -> DockerSandbox:
     global _sandbox_instance
     if _sandbox_instance is None:
-        _sandbox_instance = DockerSandbox()
+        with _sandbox_lock:
+            if _sandbox_instance is None:
+                _sandbox_instance = DockerSandbox()
     return _sandbox_instance
-
-# ---------------------------------------------------------------------------
-# ヘルパー関数
-# ---------------------------------------------------------------------------
-
-def json_escape(text: str) -> str:
-    """シングルクォート安全のため JSON エスケープ。"""
-    import json as _json
-    return _json.dumps(text)[1:-1].replace("'", "'\''")
@@ -4,27 +4,217 @@
 """
 from core.logging_config import logger
 import asyncio
+import contextvars
+import inspect
 import os
 import json
 import re
+import sys
+import threading
+import time
+import types
+from collections import OrderedDict
 from typing import Optional, Union, Dict, Any, List, Tuple
-from urllib.parse import urlparse
 from sandbox.sandbox import get_sandbox
 from tools.tool_registry import tool
 from playwright.async_api import async_playwright, Page
+from playwright.async_api import TimeoutError as PlaywrightTimeoutError
 
 
+# Playwright は API 呼び出しのたびに inspect.stack() で呼び出し元を記録するが、
+# inspect.stack() はフレームごとにソースファイルを探して読むため、要素操作が多いと大きな負荷になる。
+# PW_INSPECT_STACK=1 でない限り、ソースを読まずにフレーム情報だけを集める版に差し替える
+# （API 名やエラーメッセージに使う呼び出し元の情報はそのまま得られる）。
+def _fast_stack(context: int = 1) -> List[inspect.FrameInfo]:
+    frames = []
+    frame = sys._getframe(1)
+    while frame is not None:
+        code = frame.f_code
+        frames.append(inspect.FrameInfo(frame, code.co_filename, frame.f_lineno, code.co_name, None, None))
+        frame = frame.f_back
+    return frames
+
+
+class _FastInspect(types.ModuleType):
+    """stack() 以外は標準の inspect モジュールに委譲する"""
+
+    stack = staticmethod(_fast_stack)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(inspect, name)
+
+
+def _patch_playwright_stack() -> None:
+    if os.getenv("PW_INSPECT_STACK", "0") == "1":
+        return
+    try:
+        from playwright._impl import _connection
+    except ImportError:
+        return
+    if getattr(_connection, "inspect", None) is inspect:
+        _connection.inspect = _FastInspect("inspect")
+    else:
+        logger.debug("Playwright の内部構成が想定と異なるため inspect.stack の差し替えを行いません")
+
+
+_patch_playwright_stack()
+
 
 # グローバル変数
 _browser_context = None
 _current_page = None
+# タスクごとの操作対象ページ（未設定なら _current_page）。並列実行時に各タスクが別ページを扱えるようにする
+_ACTIVE_PAGE: contextvars.ContextVar[Optional[Page]] = contextvars.ContextVar("_ACTIVE_PAGE", default=None)
+_browser_init: Optional["asyncio.Future"] = None
 
-async def _ensure_browser(headless: bool = True):
-    """ブラウザセッションが存在することを確認し、必要に応じて初期化する"""
-    global _browser_context, _current_page
+# ページ本文として返す最大文字数（ブラウザ側で打ち切り、超過分は転送しない）
+_MAX_CONTENT_CHARS = 10000
+
+# 操作対象のページ以外に開いたままにしておくページ数の上限（ポップアップ等）
+_MAX_EXTRA_PAGES = 3
+
+# 本文抽出に不要なため読み込まないリソース種別（BROWSER_BLOCK_RESOURCES=false で無効）。
+# スタイルシートは非表示要素の判定（getComputedStyle）に必要なため対象外
+_BLOCK_RESOURCES = os.getenv("BROWSER_BLOCK_RESOURCES", "true").lower() == "true"
+_BLOCKED_RESOURCE_TYPES = frozenset({
+    "image", "imageset", "media", "font", "object", "texttrack", "beacon", "csp_report",
+})
+
+# browser_navigate_many で同時に開くページ数の上限
+_NAVIGATE_MANY_CONCURRENCY = 4
+# browser_navigate_many が使用中のページ（_trim_pages で閉じないようにする）
+_BATCH_PAGES: set = set()
+
+# input / textarea への入力を1回の evaluate で行うスクリプト。
+# React 等が値の変更を検知できるよう、ネイティブの value setter を使って input / change を発火する。
+# 対象外（contenteditable、Playwright 独自セレクタ、見つからない等）は "fallback" を返す。
+_FILL_JS = """([sel, txt]) => {
+    let el;
+    try { el = document.querySelector(sel); } catch (e) { return 'fallback'; }
+    if (!el) return 'fallback';
+    const skip = ['checkbox', 'radio', 'file', 'submit', 'button', 'image', 'reset'];
+    if (!(el.tagName === 'TEXTAREA' || (el.tagName === 'INPUT' && !skip.includes(el.type)))) return 'fallback';
+    el.scrollIntoView({block: 'center'});
+    el.focus();
+    Object.getOwnPropertyDescriptor(Object.getPrototypeOf(el), 'value').set.call(el, txt);
+    el.dispatchEvent(new Event('input', {bubbles: true}));
+    el.dispatchEvent(new Event('change', {bubbles: true}));
+    return 'ok';
+}"""
+
+# スクロールしてその時点の document.readyState を返す（dy が null なら最下部まで）
+_SCROLL_JS = """(dy) => {
+    if (dy === null) {
+        window.scrollTo(0, document.body.scrollHeight);
+    } else {
+        window.scrollBy(0, dy);
+    }
+    return document.readyState;
+}"""
+
+# Playwright のオブジェクトは作成したイベントループに紐づくため、専用スレッドで
+# 動かし続ける1つのループ上ですべてのブラウザ操作を行う（呼び出しごとにループを作らない）
+_LOOP: Optional[asyncio.AbstractEventLoop] = None
+_LOOP_LOCK = threading.Lock()
+
+
+def _get_loop() -> asyncio.AbstractEventLoop:
+    global _LOOP
+    # 起動後はロックを取らずに返す
+    if _LOOP is not None:
+        return _LOOP
+    with _LOOP_LOCK:
+        if _LOOP is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="browser-loop", daemon=True).start()
+            _LOOP = loop
+        return _LOOP
+
+
+def _page() -> Optional[Page]:
+    """現在のタスクが操作するページを返す（context.pages を問い合わせず保持している参照を使う）"""
+    return _ACTIVE_PAGE.get() or _current_page
+
+
+# browser_navigate の結果キャッシュ {URL: (取得時刻, 遷移後のURL, 結果)}。0 なら無効（既定）。
+# ファイル・シェル・デプロイ操作による変化は検知できないため、明示的に有効にしたときだけ使う
+_NAVIGATE_CACHE_TTL = float(os.getenv("BROWSER_NAVIGATE_CACHE_TTL", "0"))
+_NAVIGATE_CACHE_MAX = 64
+_NAVIGATE_CACHE: "OrderedDict[str, Tuple[float, str, str]]" = OrderedDict()
+
+
+def _cached_navigation(url: str, page: Page) -> Optional[str]:
+    """
+    有効期限内の取得結果を返す。ページの状態と食い違わないよう、一時ページ（browser_navigate_many）か
+    既にそのURLを表示している場合に限る。
+    """
+    entry = _NAVIGATE_CACHE.get(url)
+    if entry is None:
+        return None
+    fetched_at, final_url, result = entry
+    if time.monotonic() - fetched_at >= _NAVIGATE_CACHE_TTL:
+        del _NAVIGATE_CACHE[url]
+        return None
+    if page is not _ACTIVE_PAGE.get() and page.url != final_url:
+        return None
+    _NAVIGATE_CACHE.move_to_end(url)
+    return result
+
+
+def _store_navigation(url: str, final_url: str, result: str) -> None:
+    if _NAVIGATE_CACHE_TTL <= 0:
+        return
+    _NAVIGATE_CACHE[url] = (time.monotonic(), final_url, result)
+    _NAVIGATE_CACHE.move_to_end(url)
+    while len(_NAVIGATE_CACHE) > _NAVIGATE_CACHE_MAX:
+        _NAVIGATE_CACHE.popitem(last=False)
+
+
+def _invalidate_page_cache(page: Page) -> None:
+    """DOM が変わった可能性があるページについて、表示中のURLの取得結果を破棄する"""
+    url = page.url
+    for key in [k for k, entry in _NAVIGATE_CACHE.items() if entry[1] == url]:
+        del _NAVIGATE_CACHE[key]
+
+
+def _run(coro):
+    """コルーチンをブラウザ用ループで実行し、結果を同期的に返す"""
+    loop = _get_loop()
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if running is loop:
+        # ブラウザ用ループ上から同期ラッパーを呼ぶと完了を待てずにデッドロックする
+        coro.close()
+        raise RuntimeError("ブラウザ用ループ上では同期ラッパーを使わず非同期関数を直接 await してください")
+    return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+
+async def _ensure_browser(headless: bool = True, block_resources: bool = _BLOCK_RESOURCES):
+    """
+    ブラウザセッションが存在することを確認し、必要に応じて初期化する
+    
+    block_resources は初回起動時のみ有効（本文抽出に不要な画像・フォント等を読み込まない）
+    """
+    global _browser_init
     
     if _browser_context is not None:
-        return _browser_context, _current_page
+        return _browser_context, _page()
+    
+    # 同時に呼ばれても起動は1回だけ（失敗時は次回やり直す）
+    if _browser_init is None:
+        _browser_init = asyncio.ensure_future(_launch_browser(headless, block_resources))
+    try:
+        context, _ = await _browser_init
+        return context, _page()
+    except Exception:
+        _browser_init = None
+        raise
+
+
+async def _launch_browser(headless: bool, block_resources: bool = _BLOCK_RESOURCES):
+    global _browser_context, _current_page
     
     p = await async_playwright().start()
     browser = await p.chromium.launch(headless=headless)
@@ -32,41 +222,63 @@ async def _ensure_browser(headless: bool = True):
         viewport={"width": 1280, "height": 800},
         user_agent="Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/96.0.4664.110 Safari/537.36"
     )
+    if block_resources:
+        await context.route("**/*", _block_resource_route)
     
     _browser_context = context
     _current_page = await context.new_page()
+    context.on("page", _trim_pages)
     
     return context, _current_page
 
+
+async def _block_resource_route(route) -> None:
+    if route.request.resource_type in _BLOCKED_RESOURCE_TYPES:
+        await route.abort()
+    else:
+        await route.continue_()
+
+
+async def _wait_for_load(page: Page, state: str, timeout: int) -> None:
+    """読み込み状態を待つ（固定時間の待機の代わり）。時間切れでもそのまま続行する"""
+    try:
+        await page.wait_for_load_state(state, timeout=timeout)
+    except PlaywrightTimeoutError:
+        pass
+
+
+def _trim_pages(new_page: Page) -> None:
+    """ポップアップ等で開かれたページが溜まり続けないよう、上限を超えた古いページを閉じる"""
+    extra = [p for p in new_page.context.pages if p is not _current_page and p not in _BATCH_PAGES]
+    for old in extra[:max(0, len(extra) - _MAX_EXTRA_PAGES)]:
+        asyncio.ensure_future(old.close())
+
 @tool(
     name="browser_navigate",
     description="Playwrightで指定URLにアクセスする",
     parameters={
         "type": "object",
         "properties": {
-            "url": {"type": "string", "description": "アクセスするURL"}
+            "url": {"type": "string", "description": "アクセスするURL"},
+            "force_refresh": {"type": "boolean", "description": "(オプション) 直前の取得結果を使わずに再読み込みするかどうか"}
         },
         "required": ["url"]
     }
 )
-def browser_navigate(url: str):
+def browser_navigate(url: str, force_refresh: bool = False):
     """
     指定されたURLにブラウザでアクセスします。
     
     Args:
         url: アクセスするURL
+        force_refresh: 直前の取得結果を使わずに再読み込みするかどうか
         
     Returns:
         ページの内容とタイトルを含む文字列
     """
-    # 同期関数として実行
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    res = loop.run_until_complete(_navigate_async(url))
-    loop.close()
-    return res
-
-async def _navigate_async(url: str):
+    return _run(_navigate_async(url, force_refresh))
+
+async def _navigate_async(url: str, force_refresh: bool = False):
     """非同期でURLにアクセスし、ページ内容を取得"""
     context, page = await _ensure_browser(headless=True)
     
@@ -75,18 +287,24 @@ async def _navigate_async(url: str):
         if not url.startswith(('http://', 'https://')):
             url = f"https://{url}"
         
+        # 同じページを短時間に読み直す場合は前回の結果を返す
+        if not force_refresh:
+            cached = _cached_navigation(url, page)
+            if cached is not None:
+                return cached
+        
         # ページにアクセス
         await page.goto(url, timeout=30000, wait_until="domcontentloaded")
+        _invalidate_page_cache(page)
         
-        # ページが完全に読み込まれるまで少し待機
-        await asyncio.sleep(2)
-        
-        # ページのタイトルとURLを取得
-        title = await page.title()
-        current_url = page.url
+        # 通信が落ち着くまで待機（最大3秒）
+        await _wait_for_load(page, "networkidle", 3000)
         
-        # ページの内容をMarkdown形式で抽出
-        extracted_text = await _extract_content_as_markdown(page)
+        # ページのタイトル・URL・内容（Markdown形式）をまとめて取得
+        snapshot = await _extract_page_snapshot(page)
+        title = snapshot["title"]
+        current_url = snapshot["url"]
+        extracted_text = snapshot["markdown"]
         
         # 結果を整形
         result = (
@@ -98,88 +316,187 @@ async def _navigate_async(url: str):
             f"※注意: コンテンツが多すぎる場合は一部のみ表示されます。browser_scroll_downを使用して下にスクロールすると、さらに表示できます。"
         )
         
+        _store_navigation(url, current_url, result)
         return result
     except Exception as e:
         error_message = f"ナビゲーションエラー: {str(e)}"
         logger.error(error_message)
         return error_message
 
-async def _extract_content_as_markdown(page: Page) -> str:
-    """ページの内容をMarkdown形式で抽出"""
+@tool(
+    name="browser_navigate_many",
+    description="複数のURLに並列でアクセスし、それぞれのページ内容を取得する（現在のページは変更しない）",
+    parameters={
+        "type": "object",
+        "properties": {
+            "urls": {
+                "type": "array",
+                "items": {"type": "string"},
+                "description": "アクセスするURLのリスト"
+            }
+        },
+        "required": ["urls"]
+    }
+)
+def browser_navigate_many(urls: List[str]):
+    """
+    複数のURLに並列でアクセスします。各URLは一時的なページで開き、取得後に閉じます。
+    
+    Args:
+        urls: アクセスするURLのリスト
+        
+    Returns:
+        URLごとのページ内容を連結した文字列
+    """
+    return _run(_navigate_many_async(urls))
+
+async def _navigate_many_async(urls: List[str]):
+    """非同期で複数のURLに並列アクセス（同時数は _NAVIGATE_MANY_CONCURRENCY まで）"""
+    if not urls:
+        return "URLが指定されていません。"
+    
+    try:
+        context, _ = await _ensure_browser(headless=True)
+    except Exception as e:
+        error_message = f"ナビゲーションエラー: {str(e)}"
+        logger.error(error_message)
+        return error_message
+    
+    semaphore = asyncio.Semaphore(_NAVIGATE_MANY_CONCURRENCY)
+    
+    async def _navigate_one(url: str) -> str:
+        async with semaphore:
+            page = await context.new_page()
+            _BATCH_PAGES.add(page)
+            # gather は各タスクにコンテキストをコピーするため、この設定は他のタスクに影響しない
+            _ACTIVE_PAGE.set(page)
+            try:
+                return await _navigate_async(url)
+            finally:
+                _BATCH_PAGES.discard(page)
+                await page.close()
+    
+    results = await asyncio.gather(*(_navigate_one(url) for url in urls), return_exceptions=True)
+    
+    sections = []
+    for i, (url, result) in enumerate(zip(urls, results), 1):
+        if isinstance(result, BaseException):
+            result = f"ナビゲーションエラー: {str(result)}"
+        sections.append(f"# [{i}] {url}\n{result}")
+    return "\n\n---\n\n".join(sections)
+
+async def _extract_page_snapshot(page: Page) -> Dict[str, str]:
+    """
+    ページのタイトル・URL・Markdown形式の内容を1回の evaluate でまとめて取得
+    
+    Returns:
+        {"title": タイトル, "url": URL, "markdown": 内容} の辞書
+    """
     try:
         # ページからテキストコンテンツを抽出するJavaScriptを実行
-        markdown = await page.evaluate("""() => {
-            function getVisibleText(element, depth = 0) {
-                if (!element) return '';
-                
-                // 非表示要素をスキップ
-                const style = window.getComputedStyle(element);
-                if (style.display === 'none' || style.visibility === 'hidden' || style.opacity === '0') {
-                    return '';
-                }
-                
-                // テキストノードの場合
-                if (element.nodeType === Node.TEXT_NODE) {
-                    return element.textContent.trim() ? element.textContent.trim() + ' ' : '';
-                }
-                
-                // 要素の種類に基づいてマークダウン形式に変換
-                let md = '';
-                const tagName = element.tagName ? element.tagName.toLowerCase() : '';
-                
-                // 見出し
-                if (tagName.match(/^h[1-6]$/)) {
-                    const level = tagName.charAt(1);
-                    let prefix = '';
-                    for (let i = 0; i < parseInt(level); i++) {
-                        prefix += '#';
+        # 上限を超えたら DOM の走査自体を打ち切り、切り詰めた文字列だけを受け取る
+        extracted = await page.evaluate("""(limit) => {
+            // 本文として扱わない要素は配下ごと読み飛ばす
+            const SKIP_TAGS = new Set(['SCRIPT', 'STYLE', 'NOSCRIPT', 'TEMPLATE']);
+            const walker = document.createTreeWalker(
+                document.body,
+                NodeFilter.SHOW_ELEMENT | NodeFilter.SHOW_TEXT,
+                {
+                    acceptNode(node) {
+                        if (node.nodeType === Node.TEXT_NODE) return NodeFilter.FILTER_ACCEPT;
+                        if (SKIP_TAGS.has(node.tagName)) return NodeFilter.FILTER_REJECT;
+                        // 非表示要素をスキップ
+                        const style = window.getComputedStyle(node);
+                        if (style.display === 'none' || style.visibility === 'hidden' || style.opacity === '0') {
+                            return NodeFilter.FILTER_REJECT;
+                        }
+                        return NodeFilter.FILTER_ACCEPT;
                     }
-                    md += `\\n${prefix} `;
-                }
-                // 段落
-                else if (tagName === 'p') {
-                    md += '\\n\\n';
                 }
-                // リスト項目
-                else if (tagName === 'li') {
-                    md += '\\n- ';
-                }
-                // テーブル行
-                else if (tagName === 'tr') {
-                    md += '\\n|';
+            );
+            
+            // 文字列は配列に積んで最後に1回だけ連結する。上限に達したら残りは積まずに打ち切る
+            // （巨大なテキストノードがあっても上限分しか CDP で転送しない）
+            const chunks = [];
+            let length = 0;
+            let truncated = false;
+            function push(piece) {
+                if (length + piece.length > limit) {
+                    chunks.push(piece.slice(0, limit - length));
+                    length = limit;
+                    truncated = true;
+                    return;
                 }
-                // テーブルデータ
-                else if (tagName === 'td' || tagName === 'th') {
-                    md += ' ';
+                chunks.push(piece);
+                length += piece.length;
+            }
+            
+            // 要素に入るとき：要素の種類に基づいてマークダウン記法を出力
+            function enter(node) {
+                if (node.nodeType === Node.TEXT_NODE) {
+                    const text = node.data.trim();
+                    if (text) {
+                        push(text);
+                        push(' ');
+                    }
+                    return;
                 }
-                
-                // 子要素を再帰的に処理
-                for (const child of element.childNodes) {
-                    md += getVisibleText(child, depth + 1);
+                const tagName = node.tagName;
+                if (/^H[1-6]$/.test(tagName)) {
+                    push('\\n' + '#'.repeat(Number(tagName[1])) + ' ');
+                } else if (tagName === 'P') {
+                    push('\\n\\n');
+                } else if (tagName === 'LI') {
+                    push('\\n- ');
+                } else if (tagName === 'TR') {
+                    push('\\n|');
+                } else if (tagName === 'TD' || tagName === 'TH') {
+                    push(' ');
                 }
-                
-                // 特定の要素の後に改行を追加
-                if (tagName === 'div' || tagName === 'section' || tagName === 'article') {
-                    md += '\\n';
+            }
+            
+            // 要素を出るとき：特定の要素の後に改行や区切りを追加
+            function leave(node) {
+                if (node.nodeType !== Node.ELEMENT_NODE) return;
+                const tagName = node.tagName;
+                if (tagName === 'DIV' || tagName === 'SECTION' || tagName === 'ARTICLE') {
+                    push('\\n');
+                } else if (tagName === 'TD' || tagName === 'TH') {
+                    push(' |');
                 }
-                else if (tagName === 'td' || tagName === 'th') {
-                    md += ' |';
+            }
+            
+            // 再帰せずに TreeWalker で深さ優先に走査し、上限を超えたら打ち切る
+            if (document.body) {
+                enter(walker.currentNode);
+                walk: while (!truncated) {
+                    if (walker.firstChild()) {
+                        enter(walker.currentNode);
+                        continue;
+                    }
+                    while (true) {
+                        leave(walker.currentNode);
+                        if (walker.nextSibling()) {
+                            enter(walker.currentNode);
+                            continue walk;
+                        }
+                        if (!walker.parentNode()) break walk;
+                    }
                 }
-                
-                return md;
             }
             
-            return getVisibleText(document.body).replace(/\\n\\s*\\n\\s*\\n/g, '\\n\\n').trim();
-        }""")
+            const md = chunks.join('').replace(/\\n\\s*\\n\\s*\\n/g, '\\n\\n').trim();
+            return {title: document.title, url: location.href, text: md, truncated};
+        }""", _MAX_CONTENT_CHARS)
         
-        # 長すぎる場合は切り詰める
-        if len(markdown) > 10000:
-            markdown = markdown[:10000] + "...\n\n(コンテンツが長すぎるため切り詰められました)"
+        markdown = extracted["text"]
+        if extracted["truncated"]:
+            markdown += "...\n\n(コンテンツが長すぎるため切り詰められました)"
         
-        return markdown
+        return {"title": extracted["title"], "url": extracted["url"], "markdown": markdown}
     except Exception as e:
         logger.error(f"コンテンツ抽出エラー: {str(e)}")
-        return f"コンテンツの抽出に失敗しました: {str(e)}"
+        return {"title": "", "url": page.url, "markdown": f"コンテンツの抽出に失敗しました: {str(e)}"}
 
 @tool(
     name="browser_extract_elements",
@@ -204,35 +521,29 @@ def browser_extract_elements(selector: str, attribute: Optional[str] = None):
     Returns:
         抽出された要素のリストを含む文字列
     """
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    res = loop.run_until_complete(_extract_elements_async(selector, attribute))
-    loop.close()
-    return res
+    return _run(_extract_elements_async(selector, attribute))
 
 async def _extract_elements_async(selector: str, attribute: Optional[str] = None):
     """非同期で要素を抽出"""
-    if _browser_context is None or _current_page is None:
+    page = _page()
+    if _browser_context is None or page is None:
         return "ブラウザが初期化されていません。まずbrowser_navigateを使用してください。"
     
     try:
-        # セレクタに一致する要素を取得
-        elements = await _current_page.query_selector_all(selector)
+        # セレクタに一致する全要素の属性またはテキスト内容を1回の呼び出しでまとめて取得
+        values = await page.eval_on_selector_all(
+            selector,
+            "(elements, attr) => elements.map(el => attr ? el.getAttribute(attr) : (el.textContent || '').trim())",
+            attribute,
+        )
         
-        if not elements:
+        if not values:
             return f"セレクタ '{selector}' に一致する要素が見つかりませんでした。"
         
-        results = []
-        
-        for i, element in enumerate(elements):
-            if attribute:
-                # 特定の属性を抽出
-                value = await element.get_attribute(attribute)
-                results.append(f"{i+1}. [{attribute}] {value}")
-            else:
-                # テキスト内容を抽出
-                text = await element.text_content()
-                results.append(f"{i+1}. {text.strip()}")
+        if attribute:
+            results = [f"{i+1}. [{attribute}] {value}" for i, value in enumerate(values)]
+        else:
+            results = [f"{i+1}. {text}" for i, text in enumerate(values)]
         
         return f"抽出された要素 (合計: {len(results)}件):\n\n" + "\n".join(results)
     
@@ -266,36 +577,30 @@ def browser_extract_structured_data(data_type: str):
     Returns:
         抽出された構造化データを含む文字列
     """
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    res = loop.run_until_complete(_extract_structured_data_async(data_type))
-    loop.close()
-    return res
+    return _run(_extract_structured_data_async(data_type))
 
 async def _extract_structured_data_async(data_type: str):
     """非同期で構造化データを抽出"""
-    if _browser_context is None or _current_page is None:
+    page = _page()
+    if _browser_context is None or page is None:
         return "ブラウザが初期化されていません。まずbrowser_navigateを使用してください。"
     
     try:
+        # 各分岐とも、要素ごとに属性やテキストを問い合わせず1回の evaluate でまとめて取得する
         if data_type == "table":
             # テーブルデータを抽出
-            tables = await _current_page.query_selector_all("table")
+            tables = await page.evaluate("""() => Array.from(document.querySelectorAll('table'), table =>
+                Array.from(table.querySelectorAll('tr'), row =>
+                    Array.from(row.querySelectorAll('th, td'), cell => cell.textContent.trim())
+                )
+            )""")
             
             if not tables:
                 return "ページ内にテーブルが見つかりませんでした。"
             
             results = []
             
-            for i, table in enumerate(tables):
-                table_data = await _current_page.evaluate("""(table) => {
-                    const rows = Array.from(table.querySelectorAll('tr'));
-                    return rows.map(row => {
-                        const cells = Array.from(row.querySelectorAll('th, td'));
-                        return cells.map(cell => cell.textContent.trim());
-                    });
-                }""", table)
-                
+            for i, table_data in enumerate(tables):
                 if table_data and table_data[0]:
                     results.append(f"テーブル {i+1}:\n")
                     
@@ -317,33 +622,48 @@ async def _extract_structured_data_async(data_type: str):
         
         elif data_type == "list":
             # リストデータを抽出
-            lists = await _current_page.query_selector_all("ul, ol")
+            lists = await page.evaluate("""() => Array.from(document.querySelectorAll('ul, ol'), list => ({
+                ordered: list.tagName.toLowerCase() === 'ol',
+                items: Array.from(list.querySelectorAll('li'), item => item.textContent.trim()),
+            }))""")
             
             if not lists:
                 return "ページ内にリストが見つかりませんでした。"
             
             results = []
             
-            for i, list_element in enumerate(lists):
-                list_type = await list_element.get_attribute("type")
-                is_ordered = await list_element.evaluate("element => element.tagName.toLowerCase() === 'ol'")
-                
-                list_items = await list_element.query_selector_all("li")
+            for i, list_data in enumerate(lists):
+                is_ordered = list_data["ordered"]
+                list_items = list_data["items"]
                 if not list_items:
                     continue
                 
                 results.append(f"\nリスト {i+1} ({('順序付き' if is_ordered else '順序なし')}):")
                 
-                for j, item in enumerate(list_items):
-                    text = await item.text_content()
+                for j, text in enumerate(list_items):
                     prefix = f"{j+1}." if is_ordered else "-"
-                    results.append(f"{prefix} {text.strip()}")
+                    results.append(f"{prefix} {text}")
             
             return "\n".join(results)
         
         elif data_type == "form":
             # フォーム要素を抽出
-            forms = await _current_page.query_selector_all("form")
+            forms = await page.evaluate("""() => Array.from(document.querySelectorAll('form'), form => ({
+                action: form.getAttribute('action'),
+                method: form.getAttribute('method'),
+                fields: Array.from(form.querySelectorAll('input, select, textarea, button'), el => {
+                    const options = el.tagName === 'SELECT' ? Array.from(el.querySelectorAll('option')) : [];
+                    return {
+                        tag: el.tagName.toLowerCase(),
+                        type: el.getAttribute('type'),
+                        name: el.getAttribute('name'),
+                        placeholder: el.getAttribute('placeholder'),
+                        text: el.tagName === 'BUTTON' ? el.textContent.trim() : '',
+                        options: options.slice(0, 5).map(o => [o.textContent.trim(), o.getAttribute('value')]),
+                        optionCount: options.length,
+                    };
+                }),
+            }))""")
             
             if not forms:
                 return "ページ内にフォームが見つかりませんでした。"
@@ -351,87 +671,56 @@ async def _extract_structured_data_async(data_type: str):
             results = []
             
             for i, form in enumerate(forms):
-                form_action = await form.get_attribute("action") or "未指定"
-                form_method = await form.get_attribute("method") or "GET"
+                form_action = form["action"] or "未指定"
+                form_method = form["method"] or "GET"
                 
                 results.append(f"\nフォーム {i+1}:")
                 results.append(f"アクション: {form_action}")
                 results.append(f"メソッド: {form_method}")
                 results.append("フィールド:")
                 
-                input_elements = await form.query_selector_all("input, select, textarea, button")
-                
-                for input_elem in input_elements:
-                    elem_type = await input_elem.evaluate("element => element.tagName.toLowerCase()")
+                for field in form["fields"]:
+                    elem_type = field["tag"]
+                    name = field["name"] or "未指定"
                     
                     if elem_type == "input":
-                        input_type = await input_elem.get_attribute("type") or "text"
-                        name = await input_elem.get_attribute("name") or "未指定"
-                        placeholder = await input_elem.get_attribute("placeholder") or ""
+                        input_type = field["type"] or "text"
+                        placeholder = field["placeholder"] or ""
                         
                         results.append(f"- Input: type={input_type}, name={name}" + (f", placeholder=\"{placeholder}\"" if placeholder else ""))
                     
                     elif elem_type == "select":
-                        name = await input_elem.get_attribute("name") or "未指定"
-                        options = await input_elem.query_selector_all("option")
-                        option_values = []
-                        
-                        for option in options:
-                            text = await option.text_content()
-                            value = await option.get_attribute("value")
-                            option_values.append(f"{text.strip()}={value}")
-                        
-                        results.append(f"- Select: name={name}, options=[{', '.join(option_values[:5])}]" + ("..." if len(option_values) > 5 else ""))
+                        option_values = [f"{text}={value}" for text, value in field["options"]]
+                        results.append(f"- Select: name={name}, options=[{', '.join(option_values)}]" + ("..." if field["optionCount"] > 5 else ""))
                     
                     elif elem_type == "textarea":
-                        name = await input_elem.get_attribute("name") or "未指定"
                         results.append(f"- Textarea: name={name}")
                     
                     elif elem_type == "button":
-                        button_type = await input_elem.get_attribute("type") or "button"
-                        text = await input_elem.text_content()
-                        results.append(f"- Button: type={button_type}, text=\"{text.strip()}\"")
+                        button_type = field["type"] or "button"
+                        results.append(f"- Button: type={button_type}, text=\"{field['text']}\"")
             
             return "\n".join(results)
         
         elif data_type == "links":
-            # リンクを抽出
-            links = await _current_page.query_selector_all("a[href]")
+            # リンクを抽出（a.href はブラウザが <base> も考慮して解決した絶対URL）
+            links = await page.eval_on_selector_all(
+                "a[href]",
+                "(anchors) => anchors.filter(a => a.getAttribute('href')).map(a => [a.textContent.trim(), a.href])",
+            )
             
             if not links:
                 return "ページ内にリンクが見つかりませんでした。"
             
             results = ["抽出されたリンク:"]
             
-            current_url = _current_page.url
-            parsed_current = urlparse(current_url)
-            current_base = f"{parsed_current.scheme}://{parsed_current.netloc}"
-            
-            link_data = []
-            
-            for link in links:
-                text = await link.text_content()
-                href = await link.get_attribute("href")
-                
-                if not href or href.startswith("javascript:"):
+            # リンクを重複排除（最初に現れたリンクのテキストを使う）
+            link_texts: Dict[str, str] = {}
+            for text, href in links:
+                if href.startswith("javascript:"):
                     continue
-                
-                # 相対URLを絶対URLに変換
-                if href.startswith("/"):
-                    href = f"{current_base}{href}"
-                elif not href.startswith(("http://", "https://")):
-                    href = f"{current_base}/{href}"
-                
-                link_data.append({"text": text.strip() or "[画像/アイコン]", "href": href})
-            
-            # リンクを重複排除して表示
-            unique_links = []
-            seen_hrefs = set()
-            
-            for link in link_data:
-                if link["href"] not in seen_hrefs and link["text"]:
-                    unique_links.append(link)
-                    seen_hrefs.add(link["href"])
+                link_texts.setdefault(href, text or "[画像/アイコン]")
+            unique_links = [{"text": text, "href": href} for href, text in link_texts.items()]
             
             # リンクの表示（上位50件まで）
             for i, link in enumerate(unique_links[:50]):
@@ -465,24 +754,20 @@ def browser_view():
     Returns:
         ページの内容とタイトルを含む文字列
     """
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    res = loop.run_until_complete(_view_async())
-    loop.close()
-    return res
+    return _run(_view_async())
 
 async def _view_async():
     """非同期でページ内容を取得"""
-    if _browser_context is None or _current_page is None:
+    page = _page()
+    if _browser_context is None or page is None:
         return "ブラウザが初期化されていません。まずbrowser_navigateを使用してください。"
     
     try:
-        # ページのタイトルとURLを取得
-        title = await _current_page.title()
-        current_url = _current_page.url
-        
-        # ページの内容をMarkdown形式で抽出
-        extracted_text = await _extract_content_as_markdown(_current_page)
+        # ページのタイトル・URL・内容（Markdown形式）をまとめて取得
+        snapshot = await _extract_page_snapshot(page)
+        title = snapshot["title"]
+        current_url = snapshot["url"]
+        extracted_text = snapshot["markdown"]
         
         # 結果を整形
         result = (
@@ -522,20 +807,17 @@ def browser_click(selector: str, index: int = 0):
     Returns:
         クリック結果を含む文字列
     """
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    res = loop.run_until_complete(_click_async(selector, index))
-    loop.close()
-    return res
+    return _run(_click_async(selector, index))
 
 async def _click_async(selector: str, index: int = 0):
     """非同期で要素をクリック"""
-    if _browser_context is None or _current_page is None:
+    page = _page()
+    if _browser_context is None or page is None:
         return "ブラウザが初期化されていません。まずbrowser_navigateを使用してください。"
     
     try:
         # セレクタに一致する要素を取得
-        elements = await _current_page.query_selector_all(selector)
+        elements = await page.query_selector_all(selector)
         
         if not elements:
             return f"セレクタ '{selector}' に一致する要素が見つかりませんでした。"
@@ -547,13 +829,14 @@ async def _click_async(selector: str, index: int = 0):
         element = elements[index]
         await element.scroll_into_view_if_needed()
         await element.click()
+        _invalidate_page_cache(page)
         
-        # クリック後にページが変わる可能性があるので少し待機
-        await asyncio.sleep(2)
+        # クリックで遷移した場合に備えて読み込みを待機
+        await _wait_for_load(page, "domcontentloaded", 3000)
         
         # 新しいページ情報を取得
-        title = await _current_page.title()
-        url = _current_page.url
+        title = await page.title()
+        url = page.url
         
         return f"要素をクリックしました。\n現在のページ: {title} ({url})"
     
@@ -587,36 +870,40 @@ def browser_input(selector: str, text: str, press_enter: bool = False):
     Returns:
         入力結果を含む文字列
     """
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    res = loop.run_until_complete(_input_async(selector, text, press_enter))
-    loop.close()
-    return res
+    return _run(_input_async(selector, text, press_enter))
 
 async def _input_async(selector: str, text: str, press_enter: bool = False):
     """非同期で入力欄にテキストを入力"""
-    if _browser_context is None or _current_page is None:
+    page = _page()
+    if _browser_context is None or page is None:
         return "ブラウザが初期化されていません。まずbrowser_navigateを使用してください。"
     
     try:
-        # 入力欄を取得
-        input_element = await _current_page.query_selector(selector)
+        # input / textarea なら1回の evaluate で値を設定（フォーカスも移る）
+        filled = await page.evaluate(_FILL_JS, [selector, text]) == "ok"
         
-        if not input_element:
-            return f"セレクタ '{selector}' に一致する入力欄が見つかりませんでした。"
-        
-        # 現在の入力内容をクリア
-        await input_element.click()
-        await input_element.fill("")
+        if not filled:
+            # contenteditable や Playwright 独自セレクタは従来どおり要素を操作して入力
+            input_element = await page.query_selector(selector)
+            
+            if not input_element:
+                return f"セレクタ '{selector}' に一致する入力欄が見つかりませんでした。"
+            
+            # 現在の入力内容をクリア
+            await input_element.click()
+            await input_element.fill("")
+            
+            # 新しいテキストを入力
+            await input_element.type(text, delay=50)  # 人間らしく少し遅延を入れて入力
         
-        # 新しいテキストを入力
-        await input_element.type(text, delay=50)  # 人間らしく少し遅延を入れて入力
+        # 入力で表示内容が変わりうるため、このページの取得結果は破棄する
+        _invalidate_page_cache(page)
         
-        # Enterキーを押す（オプション）
+        # Enterキーを押す（オプション）。フォーム送信等が動くよう実際のキー入力として送る
         if press_enter:
-            await input_element.press("Enter")
-            # ページが変わる可能性があるので少し待機
-            await asyncio.sleep(2)
+            await page.keyboard.press("Enter")
+            # 送信で遷移した場合に備えて読み込みを待機
+            await _wait_for_load(page, "domcontentloaded", 3000)
         
         return f"テキスト「{text}」を入力しました。" + (" Enterキーを押しました。" if press_enter else "")
     
@@ -647,29 +934,31 @@ def browser_scroll_down(amount: int = 500, to_bottom: bool = False):
     Returns:
         スクロール結果を含む文字列
     """
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    res = loop.run_until_complete(_scroll_down_async(amount, to_bottom))
-    loop.close()
-    return res
+    return _run(_scroll_down_async(amount, to_bottom))
 
 async def _scroll_down_async(amount: int = 500, to_bottom: bool = False):
     """非同期でページをスクロール"""
-    if _browser_context is None or _current_page is None:
+    page = _page()
+    if _browser_context is None or page is None:
         return "ブラウザが初期化されていません。まずbrowser_navigateを使用してください。"
     
     try:
+        # スクロールと読み込み状態の確認を1回の evaluate で行う
         if to_bottom:
             # ページ最下部までスクロール
-            await _current_page.evaluate("window.scrollTo(0, document.body.scrollHeight)")
+            ready_state = await page.evaluate(_SCROLL_JS, None)
             result = "ページ最下部までスクロールしました。"
         else:
             # 指定された量だけスクロール
-            await _current_page.evaluate(f"window.scrollBy(0, {amount})")
+            ready_state = await page.evaluate(_SCROLL_JS, int(amount))
             result = f"{amount}ピクセル下にスクロールしました。"
         
-        # スクロール後に少し待機して、動的コンテンツがロードされる時間を確保
-        await asyncio.sleep(1)
+        # 読み込み途中のページではスクロール後に読み込み完了を待機
+        if ready_state != "complete":
+            try:
+                await page.wait_for_function("document.readyState === 'complete'", timeout=1500)
+            except PlaywrightTimeoutError:
+                pass
         
         return result
     
@@ -700,25 +989,22 @@ def browser_scroll_up(amount: int = 500, to_top: bool = False):
     Returns:
         スクロール結果を含む文字列
     """
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    res = loop.run_until_complete(_scroll_up_async(amount, to_top))
-    loop.close()
-    return res
+    return _run(_scroll_up_async(amount, to_top))
 
 async def _scroll_up_async(amount: int = 500, to_top: bool = False):
     """非同期でページを上にスクロール"""
-    if _browser_context is None or _current_page is None:
+    page = _page()
+    if _browser_context is None or page is None:
         return "ブラウザが初期化されていません。まずbrowser_navigateを使用してください。"
     
     try:
         if to_top:
             # ページ最上部までスクロール
-            await _current_page.evaluate("window.scrollTo(0, 0)")
+            await page.evaluate("window.scrollTo(0, 0)")
             result = "ページ最上部までスクロールしました。"
         else:
             # 指定された量だけ上にスクロール
-            await _current_page.evaluate(f"window.scrollBy(0, -{amount})")
+            await page.evaluate(_SCROLL_JS, -int(amount))
             result = f"{amount}ピクセル上にスクロールしました。"
         
         return result
@@ -751,15 +1037,12 @@ def browser_screenshot(save_path: str, selector: Optional[str] = None):
     Returns:
         スクリーンショット結果を含む文字列
     """
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    res = loop.run_until_complete(_screenshot_async(save_path, selector))
-    loop.close()
-    return res
+    return _run(_screenshot_async(save_path, selector))
 
 async def _screenshot_async(save_path: str, selector: Optional[str] = None):
     """非同期でスクリーンショットを撮影"""
-    if _browser_context is None or _current_page is None:
+    page = _page()
+    if _browser_context is None or page is None:
         return "ブラウザが初期化されていません。まずbrowser_navigateを使用してください。"
     
     try:
@@ -773,7 +1056,7 @@ async def _screenshot_async(save_path: str, selector: Optional[str] = None):
         
         if selector:
             # 特定の要素のスクリーンショットを撮影
-            element = await _current_page.query_selector(selector)
+            element = await page.query_selector(selector)
             
             if not element:
                 return f"セレクタ '{selector}' に一致する要素が見つかりませんでした。"
@@ -782,7 +1065,7 @@ async def _screenshot_async(save_path: str, selector: Optional[str] = None):
             return f"要素 '{selector}' のスクリーンショットを '{save_path}' に保存しました。"
         else:
             # ページ全体のスクリーンショットを撮影
-            await _current_page.screenshot(path=save_path, full_page=True)
+            await page.screenshot(path=save_path, full_page=True)
             return f"ページ全体のスクリーンショットを '{save_path}' に保存しました。"
     
     except Exception as e:
@@ -811,20 +1094,18 @@ def browser_run_javascript(code: str):
     Returns:
         実行結果を含む文字列
     """
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    res = loop.run_until_complete(_run_javascript_async(code))
-    loop.close()
-    return res
+    return _run(_run_javascript_async(code))
 
 async def _run_javascript_async(code: str):
     """非同期でJavaScriptを実行"""
-    if _browser_context is None or _current_page is None:
+    page = _page()
+    if _browser_context is None or page is None:
         return "ブラウザが初期化されていません。まずbrowser_navigateを使用してください。"
     
     try:
-        # JavaScriptコードを実行
-        result = await _current_page.evaluate(code)
+        # JavaScriptコードを実行（DOM を書き換えうるので取得結果は破棄）
+        result = await page.evaluate(code)
+        _invalidate_page_cache(page)
         
         # 結果の型を確認して適切に処理
         if result is None:
@@ -864,11 +1145,7 @@ def browser_extract_pdf(url: str, pages: str = ""):
     Returns:
         抽出されたテキストを含む文字列
     """
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    res = loop.run_until_complete(_extract_pdf_async(url, pages))
-    loop.close()
-    return res
+    return _run(_extract_pdf_async(url, pages))
 
 async def _extract_pdf_async(url: str, pages: str = ""):
     """非同期でPDFテキスト抽出"""
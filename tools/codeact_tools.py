@@ -15,7 +15,10 @@ from tools.tool_registry import tool
 from sandbox.sandbox import get_sandbox
 
 # 環境設定
-ALLOWED_MODULES = os.getenv("CODEACT_ALLOWED_MODULES", "os,pandas,numpy,matplotlib,requests,bs4,json,csv,re,math,datetime,time").split(",")
+ALLOWED_MODULES = frozenset(
+    m.strip() for m in os.getenv("CODEACT_ALLOWED_MODULES", "os,pandas,numpy,matplotlib,requests,bs4,json,csv,re,math,datetime,time").split(",")
+    if m.strip()
+)
 MAX_CODE_SIZE = int(os.getenv("CODEACT_MAX_CODE_SIZE", "50000"))  # 最大コードサイズ（文字数）
 EXECUTION_TIMEOUT = int(os.getenv("CODEACT_EXECUTION_TIMEOUT", "300"))  # 最大実行時間（秒）
 
@@ -157,7 +160,8 @@ def _has_forbidden_modules(code: str) -> bool:
     
     # 許可されているモジュールリスト
     for module in imports:
-        if module not in ALLOWED_MODULES and not any(module.startswith(f"{allowed}.") for allowed in ALLOWED_MODULES):
+        # import_pattern はドットを含まない先頭モジュール名のみを取り出すため集合の所属判定で足りる
+        if module not in ALLOWED_MODULES:
             logger.warning(f"禁止モジュール検出: {module}")
             return True
     
@@ -15,7 +15,7 @@ from tools.tool_registry import tool
 # 設定情報
 NGROK_ENABLED = os.getenv("ENABLE_NGROK", "false").lower() == "true"
 CLOUDFLARED_ENABLED = os.getenv("ENABLE_CLOUDFLARED", "false").lower() == "true"
-ALLOWED_PORTS = [int(p) for p in os.getenv("ALLOWED_PORTS", "3000,5000,8000,8080").split(",")]
+ALLOWED_PORTS = frozenset(int(p) for p in os.getenv("ALLOWED_PORTS", "3000,5000,8000,8080").split(",") if p.strip())
 
 @tool(
     name="deploy_expose_port",
@@ -46,7 +46,7 @@ def deploy_expose_port(port: int, protocol: str = "http"):
     
     # 許可ポート確認
     if port not in ALLOWED_PORTS:
-        return f"エラー: ポート {port} は許可されていません。許可ポート: {ALLOWED_PORTS}"
+        return f"エラー: ポート {port} は許可されていません。許可ポート: {sorted(ALLOWED_PORTS)}"
     
     # ポートの起動確認
     if not _is_port_in_use(port):
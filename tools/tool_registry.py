@@ -4,13 +4,15 @@
 CodeActパラダイムのサポートとトレーサビリティを強化。
 """
 from core.logging_config import logger
-import json
+import asyncio
 import importlib
 import functools
+import inspect
 import time
 import traceback
 from typing import Dict, Any, Callable, Optional, List
 
+from core.json_utils import dumps as _dumps
 
 
 def tool(name: str, description: str, parameters: Dict[str, Any]):
@@ -44,6 +46,7 @@ class ToolRegistry:
         self.tool_specs = {}
         self.tool_history = []  # ツール使用履歴
         self.max_history = 100  # 履歴の最大サイズ
+        self._tool_names_text: Optional[str] = None  # get_tool_names_text のキャッシュ
     
     def register_tool(self, name: str, func: Callable, spec: Dict[str, Any]):
         """
@@ -56,8 +59,39 @@ class ToolRegistry:
         """
         self.tools[name] = func
         self.tool_specs[name] = spec
+        self._tool_names_text = None
         logger.info(f"ツール登録: {name}")
     
+    def set_handler(self, name: str, func: Callable):
+        """
+        登録済みツールの実装関数だけを差し替えます（仕様はそのまま）。
+        
+        Args:
+            name: ツールの名前
+            func: 新しいツール関数
+            
+        Raises:
+            ValueError: ツールが登録されていない場合
+        """
+        if name not in self.tool_specs:
+            raise ValueError(f"ツール '{name}' は登録されていません")
+        self.tools[name] = func
+    
+    def fork(self) -> "ToolRegistry":
+        """
+        登録済みツールを引き継いだ新しいレジストリを作成します。
+        ツール関数・仕様は共有し、履歴と以降の登録内容は複製側だけが持ちます。
+        
+        Returns:
+            複製されたツールレジストリ
+        """
+        forked = ToolRegistry()
+        forked.tools = dict(self.tools)
+        forked.tool_specs = dict(self.tool_specs)
+        forked.max_history = self.max_history
+        forked._tool_names_text = self._tool_names_text
+        return forked
+    
     def register_tools_from_module(self, module_name: str):
         """
         モジュールからツールを自動登録します。
@@ -91,6 +125,18 @@ class ToolRegistry:
         """
         return list(self.tools.keys())
     
+    def get_tool_names_text(self) -> str:
+        """
+        登録されているツール名をカンマ区切りで連結した文字列を取得します。
+        ツールが登録されるまで結果をキャッシュします。
+        
+        Returns:
+            ツール名の文字列
+        """
+        if self._tool_names_text is None:
+            self._tool_names_text = ", ".join(self.tools)
+        return self._tool_names_text
+    
     def get_tool_spec(self, name: str) -> Optional[Dict[str, Any]]:
         """
         ツール仕様を取得します。
@@ -125,6 +171,7 @@ class ToolRegistry:
             
         Raises:
             ValueError: ツールが登録されていない場合
+            TypeError: 非同期ツールを同期実行しようとした場合
             Exception: ツール実行中にエラーが発生した場合
         """
         start_time = time.time()
@@ -133,10 +180,12 @@ class ToolRegistry:
             raise ValueError(f"ツール '{name}' は登録されていません")
         
         func = self.tools[name]
+        if inspect.iscoroutinefunction(func):
+            raise TypeError(f"ツール '{name}' は非同期関数です。execute_tool_async で実行してください")
         
         try:
             # 実行前にログ記録
-            params_str = json.dumps(params, ensure_ascii=False)
+            params_str = _dumps(params)
             logger.info(f"ツール実行開始: {name}({params_str})")
             
             # ツール実行
@@ -164,6 +213,46 @@ class ToolRegistry:
             # エラーを再度発生
             raise
     
+    async def execute_tool_async(self, name: str, params: Dict[str, Any]) -> Any:
+        """
+        ツールを非同期に実行します。
+        コルーチン関数として登録されたツールはイベントループ上で直接 await し、
+        同期ツールは従来通りスレッドプールで execute_tool を実行します。
+        
+        Args:
+            name: 実行するツールの名前
+            params: ツールに渡すパラメータ
+            
+        Returns:
+            ツール実行の結果
+        """
+        func = self.tools.get(name)
+        if func is None or not inspect.iscoroutinefunction(func):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, functools.partial(self.execute_tool, name, params))
+        
+        start_time = time.time()
+        
+        try:
+            params_str = _dumps(params)
+            logger.info(f"ツール実行開始: {name}({params_str})")
+            
+            result = await func(**params)
+            
+            execution_time = time.time() - start_time
+            self._add_to_history(name, params, result, execution_time)
+            logger.info(f"ツール実行完了: {name} (実行時間: {execution_time:.2f}秒)")
+            
+            return result
+        except Exception as e:
+            execution_time = time.time() - start_time
+            logger.error(f"ツール '{name}' 実行中にエラー: {str(e)}")
+            logger.error(traceback.format_exc())
+            
+            self._add_to_history(name, params, f"ERROR: {str(e)}", execution_time, error=True)
+            
+            raise
+    
     def _add_to_history(self, name: str, params: Dict[str, Any], result: Any, execution_time: float, error: bool = False):
         """
         ツール実行履歴に追加します。